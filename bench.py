@@ -0,0 +1,350 @@
+# Benchmark dei riti del bot: /generacodice, /controllacodice e /modulomensa.
+#
+# Costruisce Update sintetici e li fa passare dall'Application reale creata da
+# bot.build_application(), con un Bot finto al posto delle API di Telegram e un
+# Postgres locale (BENCH_DATABASE_URL) al posto del database di produzione.
+#
+#   BENCH_DATABASE_URL=postgresql://localhost/monastero_bench python bench.py --reset
+#   python bench.py --json risultati.json
+#   python bench.py --baseline risultati.json --tolerance 0.2
+#
+# ATTENZIONE: --reset svuota le tabelle del database indicato.
+
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+from functools import wraps
+from typing import Callable, Dict, List, Optional, Tuple
+
+if "BENCH_DATABASE_URL" not in os.environ:
+    sys.exit("Imposta BENCH_DATABASE_URL con un database Postgres locale dedicato al benchmark.")
+
+os.environ["DATABASE_URL"] = os.environ["BENCH_DATABASE_URL"]
+os.environ.setdefault("BOT_TOKEN", "123456:BENCH")
+os.environ.setdefault("WEBHOOK_URL", "https://bench.invalid")
+os.environ.setdefault("DIRECTION_CHAT_ID", "-1000000000000")
+os.environ.setdefault("NOTIFY_CHAT_INTERVAL", "0")
+os.environ.setdefault("NOTIFY_COALESCE_WINDOW", "0")
+os.environ.setdefault("METRICS_PORT", "0")
+# Gli utenti simulati inviano comandi molto più spesso di una persona reale
+os.environ.setdefault("RATE_LIMIT_COMMAND_RATE", "1000")
+os.environ.setdefault("RATE_LIMIT_UPDATE_RATE", "1000")
+
+from telegram import Update  # noqa: E402
+from telegram.request import BaseRequest  # noqa: E402
+
+import bot  # noqa: E402
+
+BOT_USER = {"id": 4242, "is_bot": True, "first_name": "Monastero", "username": "monastero_bench_bot"}
+FIRST_USER_ID = 10_000_000
+
+# Handler e helper DB da cronometrare: sono referenziati per nome globale in bot.py,
+# quindi basta sostituirli prima di build_application()
+HANDLERS = [
+    "generacodice_entry",
+    "generacodice_get_nick",
+    "generacodice_callback",
+    "controllacodice_entry",
+    "controllacodice_get_code",
+    "controllacodice_callback",
+    "modulomensa_entry",
+    "modulomensa_get_nick",
+    "modulomensa_get_qty",
+    "modulomensa_callback",
+]
+DB_HELPERS = [
+    "db_get_code",
+    "db_insert_code",
+    "db_extinguish_code",
+    "db_reserve_code",
+    "db_renew_reservation",
+    "db_release_code",
+    "save_mensa_record",
+    "get_weekly_mensa_report",
+]
+
+
+class StubRequest(BaseRequest):
+    # Risponde alle chiamate Bot API senza rete, con una latenza simulata opzionale
+
+    def __init__(self, latency: float = 0.0) -> None:
+        self.latency = latency
+        self.calls: Dict[str, int] = defaultdict(int)
+        self._message_ids = itertools.count(1_000_000)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None) -> Tuple[int, bytes]:
+        endpoint = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data is not None else {}
+        self.calls[endpoint] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if endpoint == "getMe":
+            result: object = BOT_USER
+        elif endpoint in ("sendMessage", "editMessageText", "sendDocument"):
+            chat_id = params.get("chat_id")
+            result = {
+                "message_id": params.get("message_id") or next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private" if int(chat_id) > 0 else "supergroup"},
+                "from": BOT_USER,
+                "text": params.get("text", ""),
+            }
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+class Recorder:
+    def __init__(self) -> None:
+        self.samples: Dict[str, List[float]] = defaultdict(list)
+
+    def timed(self, group: str, name: str, func: Callable) -> Callable:
+        key = f"{group}:{name}"
+
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                self.samples[key].append(time.perf_counter() - start)
+
+        return wrapper
+
+    def add(self, key: str, value: float) -> None:
+        self.samples[key].append(value)
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = max(0, math.ceil(pct / 100 * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+def summarize(samples: Dict[str, List[float]], elapsed: float) -> Dict[str, dict]:
+    summary = {}
+    for key, values in sorted(samples.items()):
+        if not values:
+            continue
+        ordered = sorted(values)
+        summary[key] = {
+            "count": len(ordered),
+            "per_second": len(ordered) / elapsed if elapsed else 0.0,
+            "mean_ms": sum(ordered) / len(ordered) * 1000,
+            "p50_ms": percentile(ordered, 50) * 1000,
+            "p95_ms": percentile(ordered, 95) * 1000,
+            "p99_ms": percentile(ordered, 99) * 1000,
+        }
+    return summary
+
+
+class UpdateFactory:
+    def __init__(self) -> None:
+        self._ids = itertools.count(1)
+
+    def _user(self, user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"Bench {user_id}", "username": f"bench{user_id}"}
+
+    def message(self, user_id: int, text: str) -> dict:
+        update_id = next(self._ids)
+        message = {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self._user(user_id),
+            "text": text,
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"update_id": update_id, "message": message}
+
+    def callback(self, user_id: int, data: str) -> dict:
+        update_id = next(self._ids)
+        return {
+            "update_id": update_id,
+            "callback_query": {
+                "id": str(update_id),
+                "chat_instance": str(user_id),
+                "from": self._user(user_id),
+                "data": data,
+                "message": {
+                    "message_id": update_id,
+                    "date": int(time.time()),
+                    "chat": {"id": user_id, "type": "private"},
+                    "from": BOT_USER,
+                    "text": "bench",
+                },
+            },
+        }
+
+
+class Bench:
+    def __init__(self, application, recorder: Recorder, rng: random.Random) -> None:
+        self.application = application
+        self.recorder = recorder
+        self.rng = rng
+        self.updates = UpdateFactory()
+        self.codes: List[str] = []
+
+    async def send(self, data: dict) -> None:
+        update = Update.de_json(data, self.application.bot)
+        # Passa dal processore come un update arrivato dal webhook
+        await self.application.update_processor.process_update(
+            update, self.application.process_update(update)
+        )
+
+    async def flow_generacodice(self, user_id: int) -> None:
+        await self.send(self.updates.message(user_id, "/generacodice"))
+        await self.send(self.updates.message(user_id, f"Fedele{self.rng.randrange(10**6)}"))
+        code = self.application.user_data[user_id].get("gen_code")
+        await self.send(self.updates.callback(user_id, "gen_confirm"))
+        if code:
+            self.codes.append(code)
+
+    async def flow_controllacodice(self, user_id: int) -> None:
+        code = self.rng.choice(self.codes) if self.codes else f"{self.rng.randrange(10000):04d}"
+        await self.send(self.updates.message(user_id, "/controllacodice"))
+        await self.send(self.updates.message(user_id, code))
+
+    async def flow_modulomensa(self, user_id: int) -> None:
+        await self.send(self.updates.message(user_id, "/modulomensa"))
+        await self.send(self.updates.message(user_id, f"Fedele{self.rng.randrange(10**6)}"))
+        await self.send(self.updates.message(user_id, f"{self.rng.randint(1, 5)} porzioni"))
+        await self.send(self.updates.callback(user_id, "mensa_confirm"))
+
+    async def run(self, flows: int, concurrency: int) -> float:
+        plan = ["generacodice"] * flows + ["controllacodice"] * flows + ["modulomensa"] * flows
+        # Prima i codici, così i controlli trovano codici reali
+        plan = plan[:flows] + self.rng.sample(plan[flows:], len(plan) - flows)
+        queues: List[List[str]] = [[] for _ in range(concurrency)]
+        for index, flow in enumerate(plan):
+            queues[index % concurrency].append(flow)
+
+        async def worker(user_id: int, todo: List[str]) -> None:
+            for flow in todo:
+                start = time.perf_counter()
+                await getattr(self, f"flow_{flow}")(user_id)
+                self.recorder.add(f"flow:{flow}", time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(
+            worker(FIRST_USER_ID + index, todo) for index, todo in enumerate(queues)
+        ))
+        return time.perf_counter() - start
+
+
+def instrument(recorder: Recorder) -> None:
+    for name in HANDLERS:
+        setattr(bot, name, recorder.timed("handler", name, getattr(bot, name)))
+    for name in DB_HELPERS:
+        setattr(bot, name, recorder.timed("db", name, getattr(bot, name)))
+    bot.notifier.enqueue = recorder.timed("db", "notifier.enqueue", bot.notifier.enqueue)
+
+
+async def reset_database() -> None:
+    await bot.open_db_pool()
+    async with bot.get_pool().connection() as conn:
+        await conn.execute(
+            """
+            DROP TABLE IF EXISTS codes, code_pool, mensa, mensa_daily, mensa_daily_unita,
+                notifications, bot_user_data, bot_conversations, roles, job_runs,
+                replicas, user_owners, forwarded_updates,
+                schema_migrations CASCADE;
+            """
+        )
+    await bot.close_db_pool()
+
+
+def print_summary(summary: Dict[str, dict], elapsed: float, calls: Dict[str, int]) -> None:
+    print(f"\nDurata: {elapsed:.2f}s\n")
+    print(f"{'misura':<40} {'n':>6} {'/s':>9} {'media':>9} {'p50':>9} {'p95':>9} {'p99':>9}")
+    for key, row in summary.items():
+        print(
+            f"{key:<40} {row['count']:>6} {row['per_second']:>9.1f} {row['mean_ms']:>8.2f}m"
+            f" {row['p50_ms']:>8.2f}m {row['p95_ms']:>8.2f}m {row['p99_ms']:>8.2f}m"
+        )
+    print("\nChiamate Bot API: " + ", ".join(f"{k}={v}" for k, v in sorted(calls.items())))
+
+
+def compare(summary: Dict[str, dict], baseline_path: str, tolerance: float) -> int:
+    with open(baseline_path) as f:
+        baseline = json.load(f)["summary"]
+    regressions = 0
+    for key, row in summary.items():
+        old = baseline.get(key)
+        if old and row["p95_ms"] > old["p95_ms"] * (1 + tolerance):
+            regressions += 1
+            print(f"REGRESSIONE {key}: p95 {old['p95_ms']:.2f}ms -> {row['p95_ms']:.2f}ms")
+    if not regressions:
+        print(f"\nNessuna regressione oltre il {tolerance:.0%} rispetto a {baseline_path}.")
+    return 1 if regressions else 0
+
+
+async def run(args: argparse.Namespace) -> int:
+    if args.reset:
+        await reset_database()
+
+    recorder = Recorder()
+    instrument(recorder)
+    stub = StubRequest(latency=args.telegram_latency / 1000)
+    application = bot.build_application(request=stub)
+
+    async with application:
+        await application.start()
+        await bot.post_init(application)
+        for index in range(args.concurrency):
+            await bot.db_grant_role(FIRST_USER_ID + index, "hermit", FIRST_USER_ID)
+        await bot.role_registry.refresh()
+
+        bench = Bench(application, recorder, random.Random(args.seed))
+        if args.warmup:
+            await bench.run(args.warmup, args.concurrency)
+            recorder.samples.clear()
+            stub.calls.clear()
+        elapsed = await bench.run(args.flows, args.concurrency)
+        await application.stop()
+    await bot.post_shutdown(application)
+
+    summary = summarize(recorder.samples, elapsed)
+    print_summary(summary, elapsed, stub.calls)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args), "elapsed": elapsed, "summary": summary}, f, indent=2)
+    if args.baseline:
+        return compare(summary, args.baseline, args.tolerance)
+    return 0
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark dei riti del bot del Monastero.")
+    parser.add_argument("--flows", type=int, default=200, help="riti per tipo (default 200)")
+    parser.add_argument("--concurrency", type=int, default=20, help="utenti simulati in parallelo")
+    parser.add_argument("--warmup", type=int, default=20, help="riti per tipo da scartare all'inizio")
+    parser.add_argument("--telegram-latency", type=float, default=0.0, help="latenza simulata Bot API (ms)")
+    parser.add_argument("--seed", type=int, default=1, help="seme per dati ripetibili")
+    parser.add_argument("--reset", action="store_true", help="cancella e ricrea le tabelle prima di partire")
+    parser.add_argument("--json", help="salva i risultati in questo file")
+    parser.add_argument("--baseline", help="confronta il p95 con un file salvato con --json")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="peggioramento p95 tollerato (default 0.2)")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(run(parse_args())))
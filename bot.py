@@ -1,24 +1,47 @@
 import asyncio
+import csv
+import gzip
+import hashlib
+import hmac
+import io
 import logging
 import os
-import random
-from typing import Optional, Tuple, List
+import re
+import socket
+import tempfile
+import time
+from collections import OrderedDict
+from decimal import Decimal
+from functools import wraps
+from typing import Awaitable, Callable, Dict, Optional, Tuple, List
 import datetime
 import html
+import json
 import psycopg
-from psycopg.rows import dict_row
+from psycopg.rows import dict_row, tuple_row
+from psycopg.types.json import Jsonb
+from psycopg_pool import AsyncConnectionPool
+from prometheus_client import REGISTRY, Counter, Gauge, Histogram, start_http_server
+from prometheus_client.core import GaugeMetricFamily
 from telegram import (
+    Bot,
     Update,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
 )
+from telegram.error import BadRequest, Forbidden, RetryAfter
+from telegram.request import BaseRequest
 from telegram.ext import (
     Application,
+    BasePersistence,
     CommandHandler,
     ConversationHandler,
     MessageHandler,
     CallbackQueryHandler,
+    BaseUpdateProcessor,
     ContextTypes,
+    PersistenceInput,
+    TypeHandler,
     filters,
 )
 
@@ -30,6 +53,7 @@ logger = logging.getLogger(__name__)
 # Conversation states
 GEN_GET_NICK = 1
 CHECK_GET_CODE = 2
+BULK_GET_LIST = 4
 MOD_MENSA_NICK, MOD_MENSA_QTY, MOD_MENSA_CONFIRM = range(300, 303)
 # Env vars
 BOT_TOKEN = os.environ["BOT_TOKEN"]
@@ -37,6 +61,53 @@ WEBHOOK_URL = os.environ["WEBHOOK_URL"]
 PORT = int(os.environ.get("PORT", "10000"))
 DATABASE_URL = os.environ["DATABASE_URL"]
 DIRECTION_CHAT_ID = int(os.environ["DIRECTION_CHAT_ID"])
+DB_POOL_MIN_SIZE = int(os.environ.get("DB_POOL_MIN_SIZE", "2"))
+DB_POOL_MAX_SIZE = int(os.environ.get("DB_POOL_MAX_SIZE", "10"))
+CODE_RESERVATION_TTL = int(os.environ.get("CODE_RESERVATION_TTL", "900"))
+CODE_CACHE_SIZE = int(os.environ.get("CODE_CACHE_SIZE", "2048"))
+CODE_CACHE_TTL = float(os.environ.get("CODE_CACHE_TTL", "300"))
+MENSA_BATCH_SIZE = int(os.environ.get("MENSA_BATCH_SIZE", "100"))
+MENSA_FLUSH_INTERVAL = float(os.environ.get("MENSA_FLUSH_INTERVAL", "0.02"))
+NOTIFY_CHAT_INTERVAL = float(os.environ.get("NOTIFY_CHAT_INTERVAL", "3"))
+NOTIFY_COALESCE_WINDOW = float(os.environ.get("NOTIFY_COALESCE_WINDOW", "1"))
+NOTIFY_POLL_INTERVAL = float(os.environ.get("NOTIFY_POLL_INTERVAL", "5"))
+NOTIFY_MAX_ATTEMPTS = int(os.environ.get("NOTIFY_MAX_ATTEMPTS", "10"))
+CLEANUP_CONCURRENCY = int(os.environ.get("CLEANUP_CONCURRENCY", "5"))
+PERSISTENCE_FLUSH_INTERVAL = float(os.environ.get("PERSISTENCE_FLUSH_INTERVAL", "15"))
+CONVERSATION_TTL = int(os.environ.get("CONVERSATION_TTL", "3600"))
+ROLE_REFRESH_INTERVAL = int(os.environ.get("ROLE_REFRESH_INTERVAL", "60"))
+RATE_LIMIT_COMMAND_BURST = int(os.environ.get("RATE_LIMIT_COMMAND_BURST", "5"))
+RATE_LIMIT_COMMAND_RATE = float(os.environ.get("RATE_LIMIT_COMMAND_RATE", "0.2"))
+RATE_LIMIT_UPDATE_BURST = int(os.environ.get("RATE_LIMIT_UPDATE_BURST", "20"))
+RATE_LIMIT_UPDATE_RATE = float(os.environ.get("RATE_LIMIT_UPDATE_RATE", "2"))
+CALLBACK_DEDUP_TTL = float(os.environ.get("CALLBACK_DEDUP_TTL", "60"))
+MULTI_REPLICA = os.environ.get("MULTI_REPLICA", "0") == "1"
+# File JSONL su cui registrare gli update in arrivo (vuoto = disattivato), vedi replay.py
+RECORD_UPDATES_PATH = os.environ.get("RECORD_UPDATES_PATH", "")
+RECORD_SALT = os.environ.get("RECORD_SALT", "")
+LEADER_CHECK_INTERVAL = float(os.environ.get("LEADER_CHECK_INTERVAL", "10"))
+MAX_CONCURRENT_UPDATES = int(os.environ.get("MAX_CONCURRENT_UPDATES", "32"))
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9091"))
+BULK_MAX_CODES = int(os.environ.get("BULK_MAX_CODES", "500"))
+BULK_MAX_FILE_SIZE = 512 * 1024
+CHECK_MAX_CODES = int(os.environ.get("CHECK_MAX_CODES", "100"))
+SEARCH_PAGE_SIZE = int(os.environ.get("SEARCH_PAGE_SIZE", "10"))
+HISTORY_PAGE_SIZE = int(os.environ.get("HISTORY_PAGE_SIZE", "10"))
+REPORT_CACHE_TTL = float(os.environ.get("REPORT_CACHE_TTL", "300"))
+REPORT_MAX_MESSAGES = int(os.environ.get("REPORT_MAX_MESSAGES", "3"))
+EXPORT_SPOOL_SIZE = int(os.environ.get("EXPORT_SPOOL_SIZE", str(1024 * 1024)))
+EXPORT_MAX_UPLOAD = 50 * 1024 * 1024
+MENSA_PARTITIONS_AHEAD = int(os.environ.get("MENSA_PARTITIONS_AHEAD", "3"))
+# Righe copiate per transazione quando mensa diventa partizionata
+MENSA_COPY_BATCH = int(os.environ.get("MENSA_COPY_BATCH", "10000"))
+# Mesi di moduli mensa da tenere nel database; 0 = nessuna archiviazione
+MENSA_RETENTION_MONTHS = int(os.environ.get("MENSA_RETENTION_MONTHS", "0"))
+MENSA_ARCHIVE_DIR = os.environ.get("MENSA_ARCHIVE_DIR", "archivio_mensa")
+
+# Topic del gruppo direzione
+CODES_THREAD_ID = 299
+MENSA_THREAD_ID = 297
+REPORT_THREAD_ID = 321
 
 INITIATES_IDS = {
     int(x.strip())
@@ -50,54 +121,238 @@ HEREMITS_IDS = {
 }
 
 
-# ---------- DB helpers ----------
+# ---------- Metriche ----------
+
+HANDLER_LATENCY = Histogram(
+    "monastero_handler_seconds", "Durata degli handler dei riti", ["handler"]
+)
+DB_LATENCY = Histogram(
+    "monastero_db_seconds", "Durata degli helper del database", ["helper"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+)
+HANDLER_ERRORS = Counter(
+    "monastero_handler_errors_total", "Eccezioni non gestite durante un update", ["error"]
+)
+NOTIFICATIONS_SENT = Counter(
+    "monastero_notifications_sent_total", "Messaggi inviati al gruppo direzione"
+)
+NOTIFICATION_FAILURES = Counter(
+    "monastero_notification_failures_total", "Invii al gruppo direzione falliti", ["reason"]
+)
+UPDATE_QUEUE_DEPTH = Gauge(
+    "monastero_update_queue_depth", "Update ricevuti e non ancora elaborati"
+)
+THROTTLED_UPDATES = Counter(
+    "monastero_throttled_updates_total", "Update scartati prima degli handler", ["reason"]
+)
+DUPLICATE_CALLBACKS = Counter(
+    "monastero_duplicate_callbacks_total", "Tocchi ripetuti su pulsanti di conferma, ignorati"
+)
+IS_LEADER = Gauge(
+    "monastero_leader", "1 se questa replica esegue i job pianificati"
+)
+UPDATES_IN_FLIGHT = Gauge(
+    "monastero_updates_in_flight", "Update in elaborazione o in attesa del proprio turno"
+)
 
-def get_conn():
-    return psycopg.connect(DATABASE_URL, row_factory=dict_row)
 
+def observe_handler(func):
+    histogram = HANDLER_LATENCY.labels(func.__name__)
 
-def ensure_tables():
-    with get_conn() as conn, conn.cursor() as cur:
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS codes (
-                id          SERIAL PRIMARY KEY,
-                code        VARCHAR(4) UNIQUE NOT NULL,
-                owner       TEXT NOT NULL,
-                created_at  TIMESTAMPTZ NOT NULL DEFAULT NOW(),
-                created_by  BIGINT NOT NULL,
-                active      BOOLEAN NOT NULL DEFAULT TRUE
-            );
-            """
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        with histogram.time():
+            return await func(*args, **kwargs)
+
+    return wrapper
+
+
+def observe_db(func):
+    histogram = DB_LATENCY.labels(func.__qualname__)
+
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        with histogram.time():
+            return await func(*args, **kwargs)
+
+    return wrapper
+
+
+class RuntimeCollector:
+    # Valori letti solo al momento dello scrape: nessun costo sul percorso degli update
+
+    def collect(self):
+        pool = GaugeMetricFamily(
+            "monastero_db_pool", "Stato del pool di connessioni", labels=["stat"]
+        )
+        if db_pool is not None:
+            stats = db_pool.get_stats()
+            for stat in ("pool_min", "pool_max", "pool_size", "pool_available", "requests_waiting"):
+                pool.add_metric([stat], stats.get(stat, 0))
+        yield pool
+
+        cache = GaugeMetricFamily(
+            "monastero_code_cache", "Cache dei codici", labels=["stat"]
         )
-        conn.commit()
+        for stat, value in code_cache.stats().items():
+            cache.add_metric([stat], value)
+        yield cache
 
+        yield GaugeMetricFamily(
+            "monastero_mensa_pending", "Moduli mensa in attesa di scrittura",
+            value=mensa_writer.pending(),
+        )
 
-def db_get_code(code: str) -> Optional[dict]:
-    with get_conn() as conn, conn.cursor() as cur:
-        cur.execute("SELECT * FROM codes WHERE code = %s;", (code,))
-        row = cur.fetchone()
-        return row
+
+# ---------- DB helpers ----------
+
+db_pool: Optional[AsyncConnectionPool] = None
+# Nome di questa istanza, anche come application_name delle connessioni del pool:
+# così le NOTIFY dei trigger dicono quale replica ha fatto la modifica (max 63 caratteri)
+REPLICA_NAME = f"{socket.gethostname()[:40]}-{os.getpid()}-{os.urandom(3).hex()}"
+
+
+async def open_db_pool() -> AsyncConnectionPool:
+    # Pool condiviso, aperto una sola volta all'avvio dell'applicazione
+    global db_pool
+    if db_pool is None:
+        db_pool = AsyncConnectionPool(
+            DATABASE_URL,
+            min_size=DB_POOL_MIN_SIZE,
+            max_size=DB_POOL_MAX_SIZE,
+            kwargs={"row_factory": dict_row, "application_name": REPLICA_NAME},
+            check=AsyncConnectionPool.check_connection,
+            name="monastero",
+            open=False,
+        )
+        await db_pool.open(wait=True)
+    return db_pool
+
+
+async def close_db_pool() -> None:
+    global db_pool, db_ready
+    if db_pool is not None:
+        await db_pool.close()
+        db_pool = None
+    db_ready = False
+
+
+db_ready = False
+
+
+async def init_db() -> None:
+    # Usata sia da post_init sia dalla persistenza, che viene caricata prima
+    global db_ready
+    await open_db_pool()
+    if not db_ready:
+        await migrate()
+        db_ready = True
 
 
-def db_insert_code(code: str, owner: str, created_by: int) -> dict:
-    with get_conn() as conn, conn.cursor() as cur:
-        cur.execute(
+def get_pool() -> AsyncConnectionPool:
+    if db_pool is None:
+        raise RuntimeError("Pool del database non inizializzato.")
+    return db_pool
+
+
+@observe_db
+async def db_get_code(code: str) -> Optional[dict]:
+    row = code_cache.get(code)
+    if row is not None:
+        return row
+
+    generation = code_cache.generation
+    async with get_pool().connection() as conn, conn.cursor() as cur:
+        await cur.execute("SELECT * FROM codes WHERE code = %s;", (code,), prepare=True)
+        row = await cur.fetchone()
+    if row is not None:
+        code_cache.put(row, generation)
+    return row
+
+
+@observe_db
+async def db_get_codes(codes: List[str]) -> Dict[str, dict]:
+    # Come db_get_code, ma risolve tutti i codici mancanti dalla cache con una sola query
+    rows = {}
+    missing = []
+    for code in codes:
+        row = code_cache.get(code)
+        if row is not None:
+            rows[code] = row
+        else:
+            missing.append(code)
+    if not missing:
+        return rows
+
+    generation = code_cache.generation
+    async with get_pool().connection() as conn, conn.cursor() as cur:
+        await cur.execute("SELECT * FROM codes WHERE code = ANY(%s);", (missing,), prepare=True)
+        for row in await cur.fetchall():
+            rows[row["code"]] = row
+            code_cache.put(row, generation)
+    return rows
+
+
+@observe_db
+async def db_search_codes(prefix: str, after: Optional[List] = None, before: Optional[List] = None,
+                          limit: int = SEARCH_PAGE_SIZE) -> List[dict]:
+    # Ricerca per prefisso del fedele con paginazione keyset su (lower(owner), id):
+    # usa codes_owner_search_idx sia per il LIKE che per l'ordinamento, senza OFFSET
+    pattern = prefix.lower().replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+    key = "(lower(owner) COLLATE \"C\", id)"
+    if before is not None:
+        condition, order, params = f"AND {key} < (%s, %s)", "DESC", [pattern, *before, limit]
+    elif after is not None:
+        condition, order, params = f"AND {key} > (%s, %s)", "ASC", [pattern, *after, limit]
+    else:
+        condition, order, params = "", "ASC", [pattern, limit]
+
+    async with get_pool().connection() as conn, conn.cursor() as cur:
+        await cur.execute(
+            f"""
+            SELECT *, lower(owner) AS owner_key FROM codes
+            WHERE lower(owner) COLLATE "C" LIKE %s {condition}
+            ORDER BY lower(owner) COLLATE "C" {order}, id {order}
+            LIMIT %s;
+            """,
+            params,
+        )
+        rows = await cur.fetchall()
+    if before is not None:
+        rows.reverse()
+    return rows
+
+
+@observe_db
+async def db_insert_code(code: str, owner: str, created_by: int) -> Optional[dict]:
+    # Consuma la prenotazione e crea il codice in un'unica istruzione:
+    # None se la prenotazione è scaduta o appartiene a qualcun altro
+    async with get_pool().connection() as conn, conn.cursor() as cur:
+        await cur.execute(
             """
+            WITH claimed AS (
+                DELETE FROM code_pool
+                WHERE code = %s AND reserved_by = %s
+                RETURNING code
+            )
             INSERT INTO codes (code, owner, created_by)
-            VALUES (%s, %s, %s)
+            SELECT code, %s, %s FROM claimed
+            ON CONFLICT (code) DO NOTHING
             RETURNING *;
             """,
-            (code, owner, created_by),
+            (code, created_by, owner, created_by),
+            prepare=True,
         )
-        row = cur.fetchone()
-        conn.commit()
-        return row
+        row = await cur.fetchone()
+    if row is not None:
+        code_cache.put(row)
+    return row
 
 
-def db_extinguish_code(code: str) -> Optional[dict]:
-    with get_conn() as conn, conn.cursor() as cur:
-        cur.execute(
+@observe_db
+async def db_extinguish_code(code: str) -> Optional[dict]:
+    async with get_pool().connection() as conn, conn.cursor() as cur:
+        await cur.execute(
             """
             UPDATE codes
             SET active = FALSE
@@ -105,28 +360,1707 @@ def db_extinguish_code(code: str) -> Optional[dict]:
             RETURNING *;
             """,
             (code,),
+            prepare=True,
         )
-        row = cur.fetchone()
-        conn.commit()
-        return row
+        row = await cur.fetchone()
+    if row is not None:
+        code_cache.put(row)
+    else:
+        code_cache.invalidate(code)
+    return row
+
+
+@observe_db
+async def db_extinguish_codes(codes: List[str]) -> List[dict]:
+    # Estingue in un'unica UPDATE tutti i codici ancora attivi tra quelli indicati
+    async with get_pool().connection() as conn, conn.cursor() as cur:
+        await cur.execute(
+            """
+            UPDATE codes
+            SET active = FALSE
+            WHERE code = ANY(%s) AND active = TRUE
+            RETURNING *;
+            """,
+            (codes,),
+            prepare=True,
+        )
+        rows = await cur.fetchall()
+    extinguished = {row["code"] for row in rows}
+    for row in rows:
+        code_cache.put(row)
+    for code in codes:
+        if code not in extinguished:
+            code_cache.invalidate(code)
+    order = {code: index for index, code in enumerate(codes)}
+    rows.sort(key=lambda row: order[row["code"]])
+    return rows
+
+
+@observe_db
+async def db_insert_codes_bulk(owners: List[str], created_by: int) -> Optional[List[dict]]:
+    # Assegna len(owners) codici liberi con un solo INSERT multi-riga nella stessa
+    # transazione: o vengono creati tutti, o nessuno (None se i codici non bastano)
+    async with get_pool().connection() as conn, conn.cursor() as cur:
+        await cur.execute(
+            """
+            WITH owners AS (
+                SELECT owner, ord FROM unnest(%s::text[]) WITH ORDINALITY AS o(owner, ord)
+            ),
+            picked AS (
+                SELECT code, row_number() OVER () AS ord
+                FROM (
+                    SELECT code FROM code_pool
+                    WHERE reserved_by IS NULL
+                    ORDER BY slot
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                ) AS free
+            ),
+            claimed AS (
+                DELETE FROM code_pool
+                WHERE code IN (SELECT code FROM picked)
+                RETURNING code
+            )
+            INSERT INTO codes (code, owner, created_by)
+            SELECT picked.code, owners.owner, %s
+            FROM picked
+            JOIN claimed USING (code)
+            JOIN owners USING (ord)
+            ORDER BY owners.ord
+            RETURNING *;
+            """,
+            (owners, len(owners), created_by),
+        )
+        rows = await cur.fetchall()
+        if len(rows) < len(owners):
+            await conn.rollback()
+            return None
+    rows.sort(key=lambda r: r["id"])
+    for row in rows:
+        code_cache.put(row)
+    return rows
+
+
+@observe_db
+async def db_reserve_code(reserved_by: int) -> Optional[str]:
+    # Prenota il primo codice libero: una sola istruzione, anche con la tabella quasi piena
+    async with get_pool().connection() as conn, conn.cursor() as cur:
+        await cur.execute(
+            """
+            UPDATE code_pool
+            SET reserved_by = %s,
+                reserved_until = NOW() + %s * interval '1 second'
+            WHERE code = (
+                SELECT code FROM code_pool
+                WHERE reserved_by IS NULL
+                ORDER BY slot
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING code;
+            """,
+            (reserved_by, CODE_RESERVATION_TTL),
+            prepare=True,
+        )
+        row = await cur.fetchone()
+        return row["code"] if row else None
+
 
+@observe_db
+async def db_renew_reservation(code: str, reserved_by: int) -> bool:
+    async with get_pool().connection() as conn, conn.cursor() as cur:
+        await cur.execute(
+            """
+            UPDATE code_pool
+            SET reserved_until = NOW() + %s * interval '1 second'
+            WHERE code = %s AND reserved_by = %s
+            RETURNING code;
+            """,
+            (CODE_RESERVATION_TTL, code, reserved_by),
+        )
+        return await cur.fetchone() is not None
+
+
+@observe_db
+async def db_release_code(code: str, reserved_by: int) -> None:
+    async with get_pool().connection() as conn, conn.cursor() as cur:
+        await cur.execute(
+            """
+            UPDATE code_pool
+            SET reserved_by = NULL, reserved_until = NULL
+            WHERE code = %s AND reserved_by = %s;
+            """,
+            (code, reserved_by),
+        )
+
+
+@observe_db
+async def db_release_expired_reservations() -> int:
+    async with get_pool().connection() as conn, conn.cursor() as cur:
+        await cur.execute(
+            """
+            UPDATE code_pool
+            SET reserved_by = NULL, reserved_until = NULL
+            WHERE reserved_by IS NOT NULL AND reserved_until < NOW();
+            """
+        )
+        return cur.rowcount
+
+
+# ---------- Migrazioni ----------
+
+# Chiave del lock advisory che impedisce a due istanze di migrare insieme
+MIGRATIONS_LOCK_ID = 7215001
+
+
+async def create_index_concurrently(conn: psycopg.AsyncConnection, name: str, definition: str) -> None:
+    # Un CREATE INDEX CONCURRENTLY interrotto lascia un indice INVALID, che
+    # IF NOT EXISTS salterebbe: in quel caso lo eliminiamo e lo ricostruiamo
+    cur = await conn.execute(
+        """
+        SELECT NOT i.indisvalid AS invalid
+        FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE c.relname = %s AND pg_table_is_visible(c.oid);
+        """,
+        (name,),
+    )
+    row = await cur.fetchone()
+    if row is not None and row["invalid"]:
+        await conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name};")
+    await conn.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} {definition};")
+
+
+async def seed_roles(conn: psycopg.AsyncConnection) -> None:
+    # Le variabili d'ambiente popolano il registro solo al primo avvio
+    await conn.execute(
+        """
+        INSERT INTO roles (user_id, role)
+        SELECT user_id, role
+        FROM (
+            SELECT unnest(%s::bigint[]) AS user_id, 'hermit' AS role
+            UNION ALL
+            SELECT unnest(%s::bigint[]), 'initiate'
+        ) AS seed
+        WHERE NOT EXISTS (SELECT 1 FROM roles)
+        ON CONFLICT (user_id) DO NOTHING;
+        """,
+        (sorted(HEREMITS_IDS), sorted(INITIATES_IDS)),
+    )
+
+
+async def backfill_quantities(conn: psycopg.AsyncConnection) -> None:
+    # Valore e unità dei moduli già registrati, ricavati dal testo libero, e totali
+    # giornalieri per unità ricostruiti. Un solo UPDATE con i testi distinti già
+    # interpretati: mensa viene letta una volta sola, senza un passaggio per testo.
+    # Usa parse_quantity com'è ora: se il parser cambia, serve un nuovo passo.
+    cur = await conn.execute("SELECT DISTINCT quantita FROM mensa;")
+    texts = [row["quantita"] for row in await cur.fetchall()]
+    parsed = [parse_quantity(text) for text in texts]
+    await conn.execute(
+        """
+        UPDATE mensa m SET quantita_valore = p.valore, quantita_unita = p.unita
+        FROM unnest(%s::text[], %s::numeric[], %s::text[]) AS p(quantita, valore, unita)
+        WHERE m.quantita = p.quantita
+          AND (m.quantita_valore IS DISTINCT FROM p.valore OR m.quantita_unita IS DISTINCT FROM p.unita);
+        """,
+        (texts, [value for value, _ in parsed], [unit for _, unit in parsed]),
+    )
+    await conn.execute(
+        """
+        DELETE FROM mensa_daily_unita;
+        INSERT INTO mensa_daily_unita (giorno, unita, totale, moduli)
+        SELECT data::date, quantita_unita, SUM(quantita_valore), COUNT(*)
+        FROM mensa
+        WHERE quantita_unita IS NOT NULL
+        GROUP BY 1, 2;
+        """
+    )
 
-def generate_unique_code() -> str:
-    # 4 cifre, assicurandosi che non esista già
+
+def month_start(day: datetime.date, offset: int = 0) -> datetime.date:
+    # Primo giorno del mese di day, spostato di offset mesi
+    months = day.year * 12 + day.month - 1 + offset
+    return datetime.date(months // 12, months % 12 + 1, 1)
+
+
+def mensa_partition_name(month: datetime.date) -> str:
+    return f"mensa_p{month:%Y_%m}"
+
+
+async def create_mensa_partitions(conn: psycopg.AsyncConnection, first: datetime.date,
+                                  last: datetime.date, parent: str = "mensa") -> List[str]:
+    # Crea le partizioni mensili mancanti dal mese di first a quello di last inclusi.
+    # Senza partizione di default un insert fuori dai mesi coperti fallirebbe:
+    # per questo se ne tengono sempre MENSA_PARTITIONS_AHEAD in anticipo.
+    created = []
+    month = month_start(first)
+    while month <= last:
+        name = mensa_partition_name(month)
+        cur = await conn.execute("SELECT to_regclass(%s) IS NOT NULL AS found;", (name,))
+        if not (await cur.fetchone())["found"]:
+            await conn.execute(
+                f"CREATE TABLE {name} PARTITION OF {parent} "
+                f"FOR VALUES FROM ('{month}') TO ('{month_start(month, 1)}');"
+            )
+            created.append(name)
+        month = month_start(month, 1)
+    return created
+
+
+MENSA_COLUMNS = "id, nickname, quantita, quantita_valore, quantita_unita, registratore_id, registratore_username, data"
+
+
+async def partition_mensa(conn: psycopg.AsyncConnection) -> None:
+    # mensa diventa partizionata per mese su data: le query con un intervallo di date
+    # leggono solo le partizioni interessate e i mesi vecchi si staccano senza DELETE.
+    # La chiave primaria deve includere data; la sequenza degli id resta la stessa.
+    # Gira fuori transazione: la nuova tabella si riempie a blocchi di MENSA_COPY_BATCH
+    # righe, ognuno con il suo commit, mentre il bot continua a usare mensa. Solo le
+    # righe dell'ultima ora e lo scambio dei nomi avvengono sotto lock, alla fine.
+    # Un tentativo interrotto riparte da capo.
+    async with conn.transaction():
+        await conn.execute(
+            """
+            DROP TABLE IF EXISTS mensa_new;
+            CREATE TABLE mensa_new (
+                id                    BIGINT NOT NULL DEFAULT nextval('mensa_id_seq'),
+                nickname              TEXT NOT NULL,
+                quantita              TEXT NOT NULL,
+                quantita_valore       NUMERIC,
+                quantita_unita        TEXT,
+                registratore_id       BIGINT NOT NULL,
+                registratore_username TEXT NOT NULL,
+                data                  TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                PRIMARY KEY (id, data)
+            ) PARTITION BY RANGE (data);
+            CREATE INDEX mensa_new_data_idx ON mensa_new (data);
+            CREATE INDEX mensa_new_nickname_data_idx ON mensa_new (lower(nickname), data DESC, id DESC);
+            """
+        )
+        cur = await conn.execute(
+            """
+            SELECT min(data)::date AS primo, max(data)::date AS ultimo,
+                   NOW() - interval '1 hour' AS limite
+            FROM mensa;
+            """
+        )
+        row = await cur.fetchone()
+        today = datetime.date.today()
+        last = month_start(today, MENSA_PARTITIONS_AHEAD)
+        await create_mensa_partitions(
+            conn, row["primo"] or today, max(row["ultimo"] or today, last), parent="mensa_new"
+        )
+    # I moduli hanno sempre data = NOW(): prima del limite non arrivano più righe
+    limit, last_id, copied = row["limite"], 0, 0
     while True:
-        code = f"{random.randint(0, 9999):04d}"
-        if db_get_code(code) is None:
-            return code
+        async with conn.transaction():
+            cur = await conn.execute(
+                f"""
+                WITH batch AS (
+                    INSERT INTO mensa_new ({MENSA_COLUMNS})
+                    SELECT {MENSA_COLUMNS} FROM mensa
+                    WHERE data < %s AND id > %s
+                    ORDER BY id
+                    LIMIT %s
+                    RETURNING id
+                )
+                SELECT count(*) AS righe, max(id) AS ultimo FROM batch;
+                """,
+                (limit, last_id, MENSA_COPY_BATCH),
+            )
+            batch = await cur.fetchone()
+        if not batch["righe"]:
+            break
+        last_id, copied = batch["ultimo"], copied + batch["righe"]
+        logger.info("Partizionamento mensa: %s righe copiate", copied)
+    # EXCLUSIVE ferma le scritture ma non le letture, fino al DROP finale
+    async with conn.transaction():
+        await conn.execute("LOCK TABLE mensa IN EXCLUSIVE MODE;")
+        await conn.execute(
+            f"INSERT INTO mensa_new ({MENSA_COLUMNS}) SELECT {MENSA_COLUMNS} FROM mensa WHERE data >= %s;",
+            (limit,),
+        )
+        await conn.execute(
+            """
+            ALTER SEQUENCE mensa_id_seq OWNED BY mensa_new.id;
+            DROP TABLE mensa;
+            ALTER TABLE mensa_new RENAME TO mensa;
+            ALTER TABLE mensa RENAME CONSTRAINT mensa_new_pkey TO mensa_pkey;
+            ALTER INDEX mensa_new_data_idx RENAME TO mensa_data_idx;
+            ALTER INDEX mensa_new_nickname_data_idx RENAME TO mensa_nickname_data_idx;
+            """
+        )
+
+
+# (versione, descrizione, SQL o funzione async che riceve la connessione, concurrently).
+# Le migrazioni già applicate non vanno mai modificate: ogni cambiamento è un nuovo passo.
+# Quelle con concurrently=True girano fuori transazione: eseguono un solo comando DDL
+# o gestiscono da sé le proprie transazioni.
+# I primi passi usano IF NOT EXISTS perché i database esistenti hanno già queste tabelle.
+MIGRATIONS: List[Tuple[int, str, object, bool]] = [
+    (1, "codes", """
+        CREATE TABLE IF NOT EXISTS codes (
+            id          SERIAL PRIMARY KEY,
+            code        VARCHAR(4) UNIQUE NOT NULL,
+            owner       TEXT NOT NULL,
+            created_at  TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            created_by  BIGINT NOT NULL,
+            active      BOOLEAN NOT NULL DEFAULT TRUE
+        );
+    """, False),
+    # Codici ancora liberi, in ordine casuale (slot) e con eventuale prenotazione
+    (2, "code_pool", """
+        CREATE TABLE IF NOT EXISTS code_pool (
+            code            VARCHAR(4) PRIMARY KEY,
+            slot            INTEGER NOT NULL,
+            reserved_by     BIGINT,
+            reserved_until  TIMESTAMPTZ
+        );
+        CREATE INDEX IF NOT EXISTS code_pool_free_idx
+            ON code_pool (slot) WHERE reserved_by IS NULL;
+        CREATE INDEX IF NOT EXISTS code_pool_reserved_idx
+            ON code_pool (reserved_until) WHERE reserved_by IS NOT NULL;
+        INSERT INTO code_pool (code, slot)
+        SELECT c.code, row_number() OVER (ORDER BY random())
+        FROM (SELECT lpad(n::text, 4, '0') AS code FROM generate_series(0, 9999) AS n) AS c
+        WHERE NOT EXISTS (SELECT 1 FROM code_pool)
+          AND NOT EXISTS (SELECT 1 FROM codes WHERE codes.code = c.code)
+        ON CONFLICT DO NOTHING;
+    """, False),
+    # Ogni modifica a codes viene annunciata alle altre istanze del bot
+    (3, "codes_changed trigger", """
+        CREATE OR REPLACE FUNCTION notify_codes_changed() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                PERFORM pg_notify('codes_changed', OLD.code);
+            ELSE
+                PERFORM pg_notify('codes_changed', NEW.code);
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        DROP TRIGGER IF EXISTS codes_changed ON codes;
+        CREATE TRIGGER codes_changed
+            AFTER INSERT OR UPDATE OR DELETE ON codes
+            FOR EACH ROW EXECUTE FUNCTION notify_codes_changed();
+    """, False),
+    (4, "mensa", """
+        CREATE TABLE IF NOT EXISTS mensa (
+            id                    BIGSERIAL PRIMARY KEY,
+            nickname              TEXT NOT NULL,
+            quantita              TEXT NOT NULL,
+            registratore_id       BIGINT NOT NULL,
+            registratore_username TEXT NOT NULL,
+            data                  TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+    """, False),
+    (5, "mensa_data_idx",
+     lambda conn: create_index_concurrently(conn, "mensa_data_idx", "ON mensa (data)"), True),
+    # Moduli per giorno e registratore, aggiornati a ogni scrittura su mensa,
+    # con il recupero dello storico la prima volta che la tabella viene creata
+    (6, "mensa_daily", """
+        CREATE TABLE IF NOT EXISTS mensa_daily (
+            giorno                DATE NOT NULL,
+            registratore_username TEXT NOT NULL,
+            moduli                INTEGER NOT NULL,
+            PRIMARY KEY (giorno, registratore_username)
+        );
+        INSERT INTO mensa_daily (giorno, registratore_username, moduli)
+        SELECT data::date, registratore_username, COUNT(*)
+        FROM mensa
+        WHERE NOT EXISTS (SELECT 1 FROM mensa_daily)
+        GROUP BY 1, 2
+        ON CONFLICT DO NOTHING;
+    """, False),
+    # Coda persistente dei messaggi verso il gruppo direzione
+    (7, "notifications", """
+        CREATE TABLE IF NOT EXISTS notifications (
+            id              BIGSERIAL PRIMARY KEY,
+            chat_id         BIGINT NOT NULL,
+            thread_id       INTEGER,
+            text            TEXT NOT NULL,
+            digest          BOOLEAN NOT NULL DEFAULT TRUE,
+            attempts        INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            created_at      TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+        CREATE INDEX IF NOT EXISTS notifications_due_idx
+            ON notifications (next_attempt_at);
+    """, False),
+    # Stato delle conversazioni e user_data, per sopravvivere ai riavvii
+    (8, "persistenza", """
+        CREATE TABLE IF NOT EXISTS bot_user_data (
+            user_id     BIGINT PRIMARY KEY,
+            data        JSONB NOT NULL,
+            updated_at  TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+        CREATE INDEX IF NOT EXISTS bot_user_data_updated_idx
+            ON bot_user_data (updated_at);
+        CREATE TABLE IF NOT EXISTS bot_conversations (
+            name        TEXT NOT NULL,
+            key         TEXT NOT NULL,
+            state       JSONB NOT NULL,
+            updated_at  TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (name, key)
+        );
+        CREATE INDEX IF NOT EXISTS bot_conversations_updated_idx
+            ON bot_conversations (updated_at);
+    """, False),
+    # Registro dei ruoli: ogni modifica viene annunciata con NOTIFY roles_changed
+    (9, "roles", """
+        CREATE TABLE IF NOT EXISTS roles (
+            user_id     BIGINT PRIMARY KEY,
+            role        TEXT NOT NULL CHECK (role IN ('hermit', 'initiate')),
+            granted_by  BIGINT,
+            granted_at  TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+        CREATE OR REPLACE FUNCTION notify_roles_changed() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('roles_changed', '');
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        DROP TRIGGER IF EXISTS roles_changed ON roles;
+        CREATE TRIGGER roles_changed
+            AFTER INSERT OR UPDATE OR DELETE ON roles
+            FOR EACH STATEMENT EXECUTE FUNCTION notify_roles_changed();
+    """, False),
+    (10, "seed roles", seed_roles, False),
+    (11, "codes_owner_search_idx",
+     lambda conn: create_index_concurrently(
+         conn, "codes_owner_search_idx", 'ON codes ((lower(owner) COLLATE "C"), id)'
+     ), True),
+    (12, "mensa_nickname_data_idx",
+     lambda conn: create_index_concurrently(
+         conn, "mensa_nickname_data_idx", "ON mensa (lower(nickname), data DESC, id DESC)"
+     ), True),
+    # Colonne numeriche per la quantità e totali giornalieri per unità; i valori dei
+    # moduli già registrati li ricava il passo 17
+    (13, "quantità strutturate", """
+        ALTER TABLE mensa
+            ADD COLUMN IF NOT EXISTS quantita_valore NUMERIC,
+            ADD COLUMN IF NOT EXISTS quantita_unita TEXT;
+        CREATE TABLE IF NOT EXISTS mensa_daily_unita (
+            giorno  DATE NOT NULL,
+            unita   TEXT NOT NULL,
+            totale  NUMERIC NOT NULL,
+            moduli  INTEGER NOT NULL,
+            PRIMARY KEY (giorno, unita)
+        );
+    """, False),
+    # Esecuzioni dei job che devono avvenire una sola volta per periodo, anche con più repliche
+    (14, "job_runs", """
+        CREATE TABLE IF NOT EXISTS job_runs (
+            name    TEXT NOT NULL,
+            period  TEXT NOT NULL,
+            ran_at  TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (name, period)
+        );
+        -- Il report della settimana scorsa l'ha già inviato la versione precedente,
+        -- che non registrava le esecuzioni: il primo leader non deve rimandarlo
+        INSERT INTO job_runs (name, period)
+        VALUES ('report_settimanale', date_trunc('week', NOW() - interval '1 week')::date::text)
+        ON CONFLICT DO NOTHING;
+    """, False),
+    (15, "mensa partizionata", partition_mensa, True),
+    # Repliche vive, proprietario di ogni utente e update inoltrati tra repliche
+    (16, "repliche", """
+        CREATE TABLE IF NOT EXISTS replicas (
+            name     TEXT PRIMARY KEY,
+            seen_at  TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+        CREATE TABLE IF NOT EXISTS user_owners (
+            user_id  BIGINT PRIMARY KEY,
+            replica  TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS forwarded_updates (
+            id          BIGSERIAL PRIMARY KEY,
+            replica     TEXT NOT NULL,
+            payload     JSONB NOT NULL,
+            created_at  TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+        CREATE INDEX IF NOT EXISTS forwarded_updates_replica_idx ON forwarded_updates (replica);
+    """, False),
+    (17, "quantità ricavate dal testo", backfill_quantities, False),
+    # Stati delle conversazioni di un utente, riletti quando passa a un'altra replica
+    (18, "indice bot_conversations per utente",
+     lambda conn: create_index_concurrently(
+         conn, "bot_conversations_user_idx", "ON bot_conversations (((key::jsonb ->> -1)::bigint))"
+     ), True),
+    # Le NOTIFY su codes portano anche l'application_name di chi ha scritto
+    (19, "codes_changed con origine", """
+        CREATE OR REPLACE FUNCTION notify_codes_changed() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                PERFORM pg_notify('codes_changed', OLD.code || ' ' || current_setting('application_name'));
+            ELSE
+                PERFORM pg_notify('codes_changed', NEW.code || ' ' || current_setting('application_name'));
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+    """, False),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+async def db_schema_version() -> int:
+    try:
+        async with get_pool().connection() as conn, conn.cursor(row_factory=tuple_row) as cur:
+            await cur.execute("SELECT max(version) FROM schema_migrations;")
+            return (await cur.fetchone())[0] or 0
+    except psycopg.errors.UndefinedTable:
+        return 0
+
+
+async def migrate() -> None:
+    # All'avvio basta una sola query: se lo schema è aggiornato non si prende nessun lock
+    if await db_schema_version() >= SCHEMA_VERSION:
+        return
+
+    # Connessione dedicata in autocommit: CREATE INDEX CONCURRENTLY non può stare in una transazione
+    async with await psycopg.AsyncConnection.connect(
+        DATABASE_URL, autocommit=True, row_factory=dict_row
+    ) as conn:
+        await conn.execute("SELECT pg_advisory_lock(%s);", (MIGRATIONS_LOCK_ID,))
+        try:
+            await conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version     INTEGER PRIMARY KEY,
+                    description TEXT NOT NULL,
+                    applied_at  TIMESTAMPTZ NOT NULL DEFAULT NOW()
+                );
+                """
+            )
+            # Un'altra istanza può aver migrato mentre aspettavamo il lock
+            cur = await conn.execute("SELECT version FROM schema_migrations;")
+            applied = {row["version"] for row in await cur.fetchall()}
+
+            for version, description, step, concurrently in MIGRATIONS:
+                if version in applied:
+                    continue
+                logger.info("Migrazione %s: %s", version, description)
+                if concurrently:
+                    await step(conn)
+                    await conn.execute(
+                        "INSERT INTO schema_migrations (version, description) VALUES (%s, %s);",
+                        (version, description),
+                    )
+                    continue
+                async with conn.transaction():
+                    if isinstance(step, str):
+                        await conn.execute(step)
+                    else:
+                        await step(conn)
+                    await conn.execute(
+                        "INSERT INTO schema_migrations (version, description) VALUES (%s, %s);",
+                        (version, description),
+                    )
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock(%s);", (MIGRATIONS_LOCK_ID,))
+
+
+# ---------- Partizioni mensa ----------
+
+async def ensure_mensa_partitions() -> List[str]:
+    # Le partizioni dei prossimi mesi; il lock evita che due istanze le creino insieme
+    async with get_pool().connection() as conn:
+        await conn.execute("SELECT pg_advisory_xact_lock(%s);", (MIGRATIONS_LOCK_ID,))
+        today = datetime.date.today()
+        return await create_mensa_partitions(conn, today, month_start(today, MENSA_PARTITIONS_AHEAD))
+
+
+async def check_mensa_partitions() -> None:
+    # Le partizioni le crea il job notturno; se il bot è rimasto fermo a lungo possono
+    # mancare quelle del mese corrente o del prossimo, e i moduli non si salverebbero
+    today = datetime.date.today()
+    async with get_pool().connection() as conn, conn.cursor(row_factory=tuple_row) as cur:
+        await cur.execute(
+            "SELECT to_regclass(%s) IS NOT NULL AND to_regclass(%s) IS NOT NULL;",
+            (mensa_partition_name(month_start(today)), mensa_partition_name(month_start(today, 1))),
+        )
+        if (await cur.fetchone())[0]:
+            return
+    created = await ensure_mensa_partitions()
+    logger.warning("Partizioni mensa mancanti, create ora: %s", ", ".join(created))
+
+
+async def archive_mensa_partitions(retention_months: int, directory: str) -> List[str]:
+    # Stacca le partizioni più vecchie di retention_months mesi, le salva in directory
+    # come CSV compressi e le elimina. Un giro interrotto viene ripreso da dove si era
+    # fermato. I totali di mensa_daily e mensa_daily_unita restano.
+    cutoff = month_start(datetime.date.today(), -retention_months)
+    archived = []
+    # Autocommit: DETACH PARTITION CONCURRENTLY non può stare in una transazione
+    async with await psycopg.AsyncConnection.connect(
+        DATABASE_URL, autocommit=True, row_factory=dict_row
+    ) as conn:
+        cur = await conn.execute(
+            """
+            SELECT c.relname, i.inhdetachpending
+            FROM pg_class c LEFT JOIN pg_inherits i ON i.inhrelid = c.oid
+            WHERE c.relkind = 'r' AND c.relname ~ '^mensa_p[0-9]{4}_[0-9]{2}$'
+              AND pg_table_is_visible(c.oid)
+            ORDER BY c.relname;
+            """
+        )
+        for row in await cur.fetchall():
+            name = row["relname"]
+            month = datetime.date(int(name[7:11]), int(name[12:14]), 1)
+            if month_start(month, 1) > cutoff:
+                continue
+            if row["inhdetachpending"]:
+                await conn.execute(f"ALTER TABLE mensa DETACH PARTITION {name} FINALIZE;")
+            elif row["inhdetachpending"] is not None:
+                await conn.execute(f"ALTER TABLE mensa DETACH PARTITION {name} CONCURRENTLY;")
+
+            # File temporaneo e rename: un archivio a metà non prende mai il nome definitivo
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, f"{name}.csv.gz")
+            with open(f"{path}.tmp", "wb") as raw:
+                with gzip.GzipFile(fileobj=raw, mode="wb") as out:
+                    async with conn.cursor() as copy_cur:
+                        async with copy_cur.copy(
+                            f"COPY (SELECT * FROM {name} ORDER BY id) TO STDOUT WITH (FORMAT csv, HEADER)"
+                        ) as copy:
+                            async for chunk in copy:
+                                out.write(chunk)
+                raw.flush()
+                os.fsync(raw.fileno())
+            os.replace(f"{path}.tmp", path)
+
+            await conn.execute(f"DROP TABLE {name};")
+            logger.info("Partizione %s archiviata in %s", name, path)
+            archived.append(name)
+    return archived
+
+
+# ---------- LISTEN/NOTIFY ----------
+
+class DbListener:
+    # Connessione dedicata in autocommit che riceve le NOTIFY e le smista per canale.
+    # Alla (ri)connessione vengono chiamate le callback on_connect, alla caduta on_disconnect.
+
+    def __init__(self) -> None:
+        self._handlers: Dict[str, List[Callable[[str], None]]] = {}
+        self._on_connect: List[Callable[[], None]] = []
+        self._on_disconnect: List[Callable[[], None]] = []
+        self._task: Optional[asyncio.Task] = None
+
+    def subscribe(self, channel: str, handler: Callable[[str], None]) -> None:
+        self._handlers.setdefault(channel, []).append(handler)
+
+    def on_connect(self, callback: Callable[[], None]) -> None:
+        self._on_connect.append(callback)
+
+    def on_disconnect(self, callback: Callable[[], None]) -> None:
+        self._on_disconnect.append(callback)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self) -> None:
+        delay = 1.0
+        while True:
+            try:
+                async with await psycopg.AsyncConnection.connect(
+                    DATABASE_URL, autocommit=True
+                ) as conn:
+                    for channel in self._handlers:
+                        await conn.execute(f'LISTEN "{channel}";')
+                    for callback in self._on_connect:
+                        callback()
+                    delay = 1.0
+                    async for notify in conn.notifies():
+                        for handler in self._handlers.get(notify.channel, []):
+                            handler(notify.payload)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("Connessione LISTEN persa: %s (nuovo tentativo tra %ss)", e, delay)
+            finally:
+                for callback in self._on_disconnect:
+                    callback()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60.0)
+
+
+db_listener = DbListener()
+
+
+# ---------- Cache codici ----------
+
+class CodeCache:
+    # LRU con scadenza per le righe di codes, indicizzate per codice.
+    # È attiva solo mentre il listener è connesso: senza NOTIFY non possiamo
+    # sapere se un'altra istanza ha estinto un codice.
+
+    def __init__(self, maxsize: int, ttl: float) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.enabled = False
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self._rows: "OrderedDict[str, Tuple[float, dict]]" = OrderedDict()
+
+    def get(self, code: str) -> Optional[dict]:
+        entry = self._rows.get(code) if self.enabled else None
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._rows[code]
+            self.misses += 1
+            return None
+        self._rows.move_to_end(code)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, row: dict, generation: Optional[int] = None) -> None:
+        # Una lettura iniziata prima di un'invalidazione o di una scrittura (generation
+        # None) non deve ripopolare la cache con la riga vecchia
+        if not self.enabled or (generation is not None and generation != self.generation):
+            return
+        if generation is None:
+            self.generation += 1
+        self._rows[row["code"]] = (time.monotonic() + self.ttl, row)
+        self._rows.move_to_end(row["code"])
+        while len(self._rows) > self.maxsize:
+            self._rows.popitem(last=False)
+
+    def invalidate(self, code: str) -> None:
+        self.generation += 1
+        self._rows.pop(code, None)
+
+    def on_changed(self, payload: str) -> None:
+        # Payload "codice replica": le modifiche di questa replica sono già nella cache
+        code, _, origin = payload.partition(" ")
+        if origin != REPLICA_NAME:
+            self.invalidate(code)
+
+    def enable(self) -> None:
+        self.clear()
+        self.enabled = True
+
+    def disable(self) -> None:
+        self.enabled = False
+        self.clear()
+
+    def clear(self) -> None:
+        self.generation += 1
+        self._rows.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._rows),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+
+code_cache = CodeCache(CODE_CACHE_SIZE, CODE_CACHE_TTL)
+db_listener.subscribe("codes_changed", code_cache.on_changed)
+db_listener.on_connect(code_cache.enable)
+db_listener.on_disconnect(code_cache.disable)
+
+
+# ---------- Notifiche direzione ----------
+
+class NotificationDispatcher:
+    # Invia in background i messaggi accodati nella tabella notifications.
+    # Rispetta un intervallo minimo per chat, riprova con backoff esponenziale
+    # e unisce in un unico messaggio le notifiche dello stesso topic arrivate insieme.
+
+    MAX_MESSAGE_LENGTH = 4096
+    DIGEST_SEPARATOR = "\n\n"
+    LEASE_SECONDS = 60
+    CLAIM_LIMIT = 50
+    # Tempo lasciato a un invio prima della scadenza del lease
+    SEND_MARGIN = 20
+
+    def __init__(self, chat_interval: float, coalesce_window: float,
+                 poll_interval: float, max_attempts: int) -> None:
+        self.chat_interval = chat_interval
+        self.coalesce_window = coalesce_window
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self._bot: Optional[Bot] = None
+        self._wakeup = asyncio.Event()
+        self._next_send_at: Dict[int, float] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+
+    def start(self, bot: Bot) -> None:
+        if self._task is None:
+            self._bot = bot
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        # I messaggi non ancora inviati restano in tabella per il prossimo avvio
+        if self._task is None:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        try:
+            await asyncio.wait_for(self._task, timeout=10)
+        except asyncio.TimeoutError:
+            pass
+        self._task = None
+
+    @observe_db
+    async def enqueue(self, text: str, thread_id: Optional[int],
+                      chat_id: int = DIRECTION_CHAT_ID, digest: bool = True) -> None:
+        async with get_pool().connection() as conn, conn.cursor() as cur:
+            await cur.execute(
+                """
+                INSERT INTO notifications (chat_id, thread_id, text, digest)
+                VALUES (%s, %s, %s, %s);
+                """,
+                (chat_id, thread_id, text, digest),
+                prepare=True,
+            )
+        self._wakeup.set()
+
+    async def _run(self) -> None:
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                # Lascia arrivare il resto della raffica per unirla in un solo messaggio
+                await asyncio.sleep(self.coalesce_window)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                while not self._stopping:
+                    lease_until = asyncio.get_running_loop().time() + self.LEASE_SECONDS
+                    rows = await self._claim()
+                    if not rows:
+                        break
+                    await self._deliver(rows, lease_until)
+            except Exception as e:
+                logger.error("Errore nel dispatcher delle notifiche: %s", e)
+
+    async def _claim(self) -> List[dict]:
+        async with get_pool().connection() as conn, conn.cursor() as cur:
+            await cur.execute(
+                """
+                UPDATE notifications
+                SET next_attempt_at = NOW() + %s * interval '1 second'
+                WHERE id IN (
+                    SELECT id FROM notifications
+                    WHERE next_attempt_at <= NOW()
+                    ORDER BY id
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING *;
+                """,
+                (self.LEASE_SECONDS, self.CLAIM_LIMIT),
+            )
+            rows = await cur.fetchall()
+        return sorted(rows, key=lambda r: r["id"])
+
+    def _coalesce(self, rows: List[dict]) -> List[Tuple[dict, List[dict]]]:
+        # Raggruppa per (chat, topic); ogni gruppo diventa uno o più messaggi entro i 4096 caratteri
+        messages: List[Tuple[dict, List[dict]]] = []
+        open_digest: Dict[Tuple[int, Optional[int]], Tuple[dict, List[dict]]] = {}
+        for row in rows:
+            key = (row["chat_id"], row["thread_id"])
+            current = open_digest.get(key) if row["digest"] else None
+            if current is not None:
+                text = current[0]["text"] + self.DIGEST_SEPARATOR + row["text"]
+                if len(text) <= self.MAX_MESSAGE_LENGTH:
+                    current[0]["text"] = text
+                    current[1].append(row)
+                    continue
+            message = ({"chat_id": row["chat_id"], "thread_id": row["thread_id"], "text": row["text"]}, [row])
+            messages.append(message)
+            if row["digest"]:
+                open_digest[key] = message
+        return messages
+
+    async def _deliver(self, rows: List[dict], lease_until: float) -> None:
+        # Con la stessa chat la cadenza di chat_interval può allungare il giro oltre il lease:
+        # prima che scada, i messaggi non ancora inviati vengono rilasciati invece di essere
+        # ripresi (e inviati di nuovo) da un'altra replica mentre questa li sta inviando
+        loop = asyncio.get_running_loop()
+        messages = self._coalesce(rows)
+        for index, (message, sources) in enumerate(messages):
+            chat_id = message["chat_id"]
+            wait = max(self._next_send_at.get(chat_id, 0.0) - loop.time(), 0.0)
+            if loop.time() + wait + self.SEND_MARGIN > lease_until:
+                await self._release(messages[index:])
+                return
+            if wait > 0:
+                await asyncio.sleep(wait)
+            ids = [r["id"] for r in sources]
+            try:
+                await self._bot.send_message(
+                    chat_id=chat_id,
+                    text=message["text"],
+                    message_thread_id=message["thread_id"],
+                    parse_mode="HTML"
+                )
+            except RetryAfter as e:
+                NOTIFICATION_FAILURES.labels("retry_after").inc()
+                logger.warning("Limite Telegram raggiunto, riprovo tra %ss", e.retry_after)
+                self._next_send_at[chat_id] = loop.time() + e.retry_after
+                await self._reschedule(ids, e.retry_after, count_attempt=False)
+                continue
+            except (BadRequest, Forbidden) as e:
+                # Errori permanenti: riprovare non servirebbe
+                NOTIFICATION_FAILURES.labels("rejected").inc()
+                logger.error("Notifica direzione scartata (%s): %s", ids, e)
+                await self._delete(ids)
+                continue
+            except Exception as e:
+                NOTIFICATION_FAILURES.labels("error").inc()
+                attempts = max(r["attempts"] for r in sources) + 1
+                if attempts >= self.max_attempts:
+                    logger.error("Notifica direzione scartata dopo %s tentativi (%s): %s", attempts, ids, e)
+                    await self._delete(ids)
+                else:
+                    logger.warning("Errore invio messaggio direzione, tentativo %s: %s", attempts, e)
+                    await self._reschedule(ids, min(5 * 2 ** attempts, 3600))
+                continue
+            finally:
+                self._next_send_at[chat_id] = max(
+                    self._next_send_at.get(chat_id, 0.0), loop.time() + self.chat_interval
+                )
+            NOTIFICATIONS_SENT.inc()
+            await self._delete(ids)
+
+    async def _release(self, messages: List[Tuple[dict, List[dict]]]) -> None:
+        # Ogni messaggio torna disponibile quando la sua chat può riceverne di nuovo
+        loop = asyncio.get_running_loop()
+        by_delay: Dict[float, List[int]] = {}
+        for message, sources in messages:
+            delay = max(self._next_send_at.get(message["chat_id"], 0.0) - loop.time(), 0.0)
+            by_delay.setdefault(round(delay, 1), []).extend(r["id"] for r in sources)
+        for delay, ids in by_delay.items():
+            await self._reschedule(ids, delay, count_attempt=False)
+
+    async def _delete(self, ids: List[int]) -> None:
+        async with get_pool().connection() as conn, conn.cursor() as cur:
+            await cur.execute("DELETE FROM notifications WHERE id = ANY(%s);", (ids,))
+
+    async def _reschedule(self, ids: List[int], delay: float, count_attempt: bool = True) -> None:
+        async with get_pool().connection() as conn, conn.cursor() as cur:
+            await cur.execute(
+                """
+                UPDATE notifications
+                SET attempts = attempts + %s,
+                    next_attempt_at = NOW() + %s * interval '1 second'
+                WHERE id = ANY(%s);
+                """,
+                (1 if count_attempt else 0, delay, ids),
+            )
+
+
+notifier = NotificationDispatcher(
+    NOTIFY_CHAT_INTERVAL, NOTIFY_COALESCE_WINDOW, NOTIFY_POLL_INTERVAL, NOTIFY_MAX_ATTEMPTS
+)
+
+
+def split_message(header: str, lines: List[str],
+                  limit: int = NotificationDispatcher.MAX_MESSAGE_LENGTH) -> List[str]:
+    # Divide le righe in più messaggi sotto il limite di Telegram; l'intestazione va nel primo
+    messages = []
+    text = header
+    for line in lines:
+        if len(text) + len(line) > limit and text:
+            messages.append(text)
+            text = ""
+        text += line
+    messages.append(text)
+    return messages
+
+
+def join_within_limit(header: str, lines: List[str],
+                      limit: int = NotificationDispatcher.MAX_MESSAGE_LENGTH) -> str:
+    # Accoda le righe finché il messaggio resta sotto il limite di Telegram
+    text = header
+    for index, line in enumerate(lines):
+        if len(text) + len(line) > limit - 40:
+            return text + f"… e altri {len(lines) - index}"
+        text += line
+    return text
+
+
+# ---------- Repliche ----------
+
+# Chiave del lock advisory tenuto dalla replica che esegue i job pianificati
+LEADER_LOCK_ID = 7215002
+
+
+class LeaderElection:
+    # Una sola replica alla volta esegue i job pianificati: quella che tiene il lock
+    # advisory LEADER_LOCK_ID sulla propria connessione dedicata. Se la replica muore,
+    # Postgres rilascia il lock con la sessione e un'altra lo prende al controllo successivo.
+
+    def __init__(self, interval: float) -> None:
+        self.interval = interval
+        self.is_leader = False
+        self._conn: Optional[psycopg.AsyncConnection] = None
+        self._task: Optional[asyncio.Task] = None
+        self._on_elected: List[Callable[[], Awaitable[None]]] = []
+
+    def on_elected(self, callback: Callable[[], Awaitable[None]]) -> None:
+        # Chiamate ogni volta che questa replica diventa leader
+        self._on_elected.append(callback)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self._close()
+
+    def _set_leader(self, value: bool) -> None:
+        elected = value and not self.is_leader
+        if value != self.is_leader:
+            logger.info("Questa replica %s i job pianificati", "esegue" if value else "non esegue più")
+        self.is_leader = value
+        IS_LEADER.set(1 if value else 0)
+        if elected:
+            for callback in self._on_elected:
+                asyncio.create_task(self._call(callback))
+
+    async def _call(self, callback: Callable[[], Awaitable[None]]) -> None:
+        try:
+            await callback()
+        except Exception as e:
+            logger.error("Recupero dei job alla nomina del leader non riuscito (%s): %s", callback.__name__, e)
+
+    async def _close(self) -> None:
+        # Chiudere la sessione rilascia il lock
+        self._set_leader(False)
+        if self._conn is not None:
+            try:
+                await self._conn.close()
+            except Exception:
+                pass
+            self._conn = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                if self._conn is None or self._conn.closed:
+                    self._set_leader(False)
+                    self._conn = await psycopg.AsyncConnection.connect(DATABASE_URL, autocommit=True)
+                if self.is_leader:
+                    # Basta che la sessione sia viva: il lock è suo finché non si chiude
+                    await self._conn.execute("SELECT 1;")
+                else:
+                    cur = await self._conn.execute(
+                        "SELECT pg_try_advisory_lock(%s);", (LEADER_LOCK_ID,)
+                    )
+                    self._set_leader((await cur.fetchone())[0])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("Elezione del leader non riuscita: %s", e)
+                await self._close()
+            await asyncio.sleep(self.interval)
+
+
+leader = LeaderElection(LEADER_CHECK_INTERVAL)
+
+
+def leader_only(job):
+    # I job decorati non fanno nulla sulle repliche che non sono leader
+    @wraps(job)
+    async def wrapper(context: ContextTypes.DEFAULT_TYPE):
+        if not leader.is_leader:
+            return None
+        return await job(context)
+
+    return wrapper
+
+
+async def db_claim_job_run(name: str, period: str) -> bool:
+    # True solo per la prima replica che esegue il job in quel periodo
+    async with get_pool().connection() as conn, conn.cursor() as cur:
+        await cur.execute(
+            """
+            INSERT INTO job_runs (name, period) VALUES (%s, %s)
+            ON CONFLICT DO NOTHING
+            RETURNING name;
+            """,
+            (name, period),
+        )
+        return await cur.fetchone() is not None
+
+
+class ReplicaRouter:
+    # Con MULTI_REPLICA ogni utente appartiene a una sola replica viva, che gestisce tutti
+    # i suoi update: stati delle conversazioni, user_data in memoria e timeout dei riti
+    # restano su una sola istanza. La replica che riceve dal webhook l'update di un utente
+    # altrui lo inoltra al proprietario con la tabella forwarded_updates e una NOTIFY.
+    # Un utente passa a un'altra replica solo quando la sua si spegne o smette di dare
+    # segni di vita per dead_after secondi: i riti rimasti a metà su quella ricominciano.
+
+    MAX_OWNED = 10000
+
+    def __init__(self, interval: float) -> None:
+        self.interval = interval
+        self.dead_after = interval * 3
+        self.name = REPLICA_NAME
+        self.application: Optional[Application] = None
+        # Utenti di questa replica, validi finché il suo battito è recente
+        self._owned: "OrderedDict[int, None]" = OrderedDict()
+        self._alive_until = 0.0
+        # Utenti appena presi da un'altra replica, il cui user_data va riletto
+        self._reload: set = set()
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.application is not None
+
+    async def start(self, application: Application) -> None:
+        # Il primo battito prima di accettare utenti, altrimenti gli altri ci crederebbero morti
+        await self._heartbeat()
+        self.application = application
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.application is None:
+            return
+        self.application = None
+        # Gli utenti passano subito alle altre repliche, senza aspettare dead_after
+        try:
+            async with get_pool().connection() as conn:
+                await conn.execute("DELETE FROM user_owners WHERE replica = %s;", (self.name,))
+                await conn.execute("DELETE FROM replicas WHERE name = %s;", (self.name,))
+        except Exception as e:
+            logger.warning("Impossibile cedere gli utenti di %s: %s", self.name, e)
+
+    def notify(self, payload: str) -> None:
+        if payload == self.name:
+            self._wake.set()
+
+    def take_reload(self, user_id: int) -> bool:
+        if user_id in self._reload:
+            self._reload.discard(user_id)
+            return True
+        return False
+
+    async def route(self, key: int, update: Update) -> bool:
+        # True se l'update va gestito qui, False se è stato inoltrato al proprietario
+        if key in self._owned and time.monotonic() < self._alive_until:
+            self._owned.move_to_end(key)
+            return True
+        try:
+            owner, claimed = await db_claim_user(key, self.name, self.dead_after)
+            if owner != self.name:
+                await db_forward_update(owner, update.to_dict())
+                return False
+        except Exception as e:
+            logger.warning("Instradamento dell'utente %s non riuscito, lo gestisco qui: %s", key, e)
+            return True
+        self._owned[key] = None
+        while len(self._owned) > self.MAX_OWNED:
+            self._owned.popitem(last=False)
+        if claimed:
+            self._reload.add(key)
+            await self._load_conversations(key)
+        return True
+
+    async def _load_conversations(self, user_id: int) -> None:
+        # Un utente appena preso da un'altra replica (anche in un normale riavvio a
+        # rotazione) può essere a metà di un rito: i suoi stati salvati sostituiscono
+        # quelli rimasti in memoria da un suo eventuale passaggio precedente su questa.
+        # PTB carica gli stati solo all'avvio e non ha un'API per ricaricarli: si scrive
+        # nel TrackingDict del ConversationHandler senza segnare modifiche da salvare.
+        stored = await self.application.persistence.get_user_conversations(user_id)
+        for handlers in self.application.handlers.values():
+            for handler in handlers:
+                if not (isinstance(handler, ConversationHandler) and handler.persistent):
+                    continue
+                conversations = handler._conversations
+                for conv_key in [conv_key for conv_key in conversations if conv_key[-1] == user_id]:
+                    del conversations.data[conv_key]
+                conversations.update_no_track(stored.get(handler.name, {}))
+
+    async def _heartbeat(self) -> None:
+        async with get_pool().connection() as conn:
+            await conn.execute(
+                """
+                INSERT INTO replicas (name) VALUES (%s)
+                ON CONFLICT (name) DO UPDATE SET seen_at = NOW();
+                """,
+                (self.name,),
+            )
+            # Le repliche sparite da un giorno non servono più neanche come storico
+            await conn.execute("DELETE FROM replicas WHERE seen_at < NOW() - interval '1 day';")
+        self._alive_until = time.monotonic() + self.dead_after
+
+    async def _drain(self) -> None:
+        # Update inoltrati a questa replica e quelli rimasti a repliche morte, che
+        # ripassano dall'instradamento. Ognuno parte in ordine di arrivo come dal webhook.
+        async with get_pool().connection() as conn, conn.cursor() as cur:
+            await cur.execute(
+                """
+                DELETE FROM forwarded_updates
+                WHERE id IN (
+                    SELECT f.id FROM forwarded_updates f
+                    WHERE f.replica = %s OR NOT EXISTS (
+                        SELECT 1 FROM replicas r
+                        WHERE r.name = f.replica AND r.seen_at > NOW() - %s * interval '1 second'
+                    )
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id, payload;
+                """,
+                (self.name, self.dead_after),
+            )
+            rows = sorted(await cur.fetchall(), key=lambda row: row["id"])
+        application = self.application
+        for row in rows:
+            update = Update.de_json(row["payload"], application.bot)
+            application.create_task(
+                application.update_processor.process_update(update, application.process_update(update)),
+                update=update,
+            )
+
+    async def _run(self) -> None:
+        next_heartbeat = time.monotonic() + self.interval
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                if time.monotonic() >= next_heartbeat:
+                    next_heartbeat = time.monotonic() + self.interval
+                    await self._heartbeat()
+                await self._drain()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("Sincronizzazione della replica %s non riuscita: %s", self.name, e)
+
+
+replica_router = ReplicaRouter(LEADER_CHECK_INTERVAL)
+if MULTI_REPLICA:
+    db_listener.subscribe("forwarded_updates", replica_router.notify)
+
+
+async def db_claim_user(user_id: int, replica: str, dead_after: float) -> Tuple[str, bool]:
+    # Proprietario dell'utente e se lo è appena diventata replica: chi non ha
+    # proprietario o ne ha uno morto passa a replica
+    async with get_pool().connection() as conn, conn.cursor(row_factory=tuple_row) as cur:
+        for _ in range(3):
+            await cur.execute(
+                """
+                WITH claim AS (
+                    INSERT INTO user_owners (user_id, replica) VALUES (%(user)s, %(replica)s)
+                    ON CONFLICT (user_id) DO UPDATE SET replica = EXCLUDED.replica
+                    WHERE user_owners.replica NOT IN (
+                        SELECT name FROM replicas
+                        WHERE seen_at > NOW() - %(dead_after)s * interval '1 second'
+                    )
+                    RETURNING replica
+                )
+                SELECT (SELECT replica FROM claim),
+                       (SELECT replica FROM user_owners WHERE user_id = %(user)s);
+                """,
+                {"user": user_id, "replica": replica, "dead_after": dead_after},
+            )
+            claimed, owner = await cur.fetchone()
+            if claimed is not None:
+                return claimed, True
+            # Nessuno dei due se un'altra replica l'ha inserito mentre questa query partiva
+            if owner is not None:
+                return owner, False
+    raise RuntimeError(f"Proprietario dell'utente {user_id} non determinabile")
+
+
+async def db_forward_update(replica: str, payload: dict) -> None:
+    async with get_pool().connection() as conn:
+        await conn.execute(
+            """
+            WITH forwarded AS (
+                INSERT INTO forwarded_updates (replica, payload) VALUES (%s, %s)
+                RETURNING replica
+            )
+            SELECT pg_notify('forwarded_updates', replica) FROM forwarded;
+            """,
+            (replica, Jsonb(payload)),
+        )
+
+
+# ---------- Persistenza ----------
+
+class PostgresPersistence(BasePersistence):
+    # Salva user_data e stati delle conversazioni su Postgres. PTB chiama gli
+    # update_* ogni PERSISTENCE_FLUSH_INTERVAL secondi; le scritture accumulate in
+    # quel giro vengono inviate insieme. Gli stati più vecchi di CONVERSATION_TTL
+    # non vengono ricaricati e vengono cancellati dal job di scadenza.
+
+    def __init__(self, update_interval: float, ttl: int) -> None:
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.ttl = ttl
+        self._pending_users: Dict[int, Optional[dict]] = {}
+        self._pending_conversations: Dict[Tuple[str, str], object] = {}
+        self._write_task: Optional[asyncio.Task] = None
+        # Le scritture vanno in ordine: flush() deve anche attendere quelle già partite
+        self._write_lock = asyncio.Lock()
+        # Ultimo update di ogni utente in memoria su questa replica, per scaricare gli inattivi
+        self._last_seen: Dict[int, float] = {}
+        # Utenti scaricati solo dalla memoria: il drop non deve cancellarne i dati salvati
+        self._memory_only_drops: set = set()
+
+    @staticmethod
+    def _encode_key(key: tuple) -> str:
+        return json.dumps(list(key))
+
+    async def get_user_data(self) -> Dict[int, dict]:
+        await init_db()
+        async with get_pool().connection() as conn, conn.cursor() as cur:
+            await cur.execute(
+                """
+                SELECT user_id, data FROM bot_user_data
+                WHERE updated_at > NOW() - %s * interval '1 second';
+                """,
+                (self.ttl,),
+            )
+            users = {row["user_id"]: row["data"] for row in await cur.fetchall()}
+        now = time.monotonic()
+        self._last_seen.update((user_id, now) for user_id in users)
+        return users
+
+    async def get_chat_data(self) -> Dict[int, dict]:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        await init_db()
+        async with get_pool().connection() as conn, conn.cursor() as cur:
+            # Con più repliche si caricano solo i riti degli utenti senza un proprietario
+            # vivo: gli altri restano alla replica che li sta seguendo
+            await cur.execute(
+                """
+                SELECT key, state FROM bot_conversations c
+                WHERE name = %s AND updated_at > NOW() - %s * interval '1 second'
+                  AND NOT (%s AND EXISTS (
+                      SELECT 1 FROM user_owners o JOIN replicas r ON r.name = o.replica
+                      WHERE o.user_id = (c.key::jsonb ->> -1)::bigint
+                        AND r.seen_at > NOW() - %s * interval '1 second'
+                  ));
+                """,
+                (name, self.ttl, MULTI_REPLICA, replica_router.dead_after),
+            )
+            return {tuple(json.loads(row["key"])): row["state"] for row in await cur.fetchall()}
+
+    async def get_user_conversations(self, user_id: int) -> Dict[str, dict]:
+        # Stati salvati di un solo utente, per nome della conversazione
+        async with get_pool().connection() as conn, conn.cursor() as cur:
+            await cur.execute(
+                """
+                SELECT name, key, state FROM bot_conversations
+                WHERE (key::jsonb ->> -1)::bigint = %s
+                  AND updated_at > NOW() - %s * interval '1 second';
+                """,
+                (user_id, self.ttl),
+            )
+            conversations: Dict[str, dict] = {}
+            for row in await cur.fetchall():
+                conversations.setdefault(row["name"], {})[tuple(json.loads(row["key"]))] = row["state"]
+            return conversations
+
+    async def update_conversation(self, name: str, key: tuple, new_state: Optional[object]) -> None:
+        self._pending_conversations[(name, self._encode_key(key))] = new_state
+        self._schedule_write()
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self._pending_users[user_id] = dict(data) if data else None
+        self._schedule_write()
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data: object) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def drop_user_data(self, user_id: int) -> None:
+        if user_id in self._memory_only_drops:
+            self._memory_only_drops.discard(user_id)
+            return
+        self._pending_users[user_id] = None
+        self._schedule_write()
+
+    def sweep_idle(self) -> List[int]:
+        # Utenti senza update su questa replica da più di ttl secondi, da scaricare dalla
+        # memoria; le righe nel database le cancella solo il leader con expire()
+        limit = time.monotonic() - self.ttl
+        idle = [user_id for user_id, seen in self._last_seen.items() if seen < limit]
+        for user_id in idle:
+            del self._last_seen[user_id]
+            self._memory_only_drops.add(user_id)
+        return idle
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        # Si rilegge dal database l'user_data di un utente appena passato qui da un'altra
+        # replica o scaricato dalla memoria per inattività (le modifiche locali non ancora
+        # scritte restano le più recenti)
+        known = user_id in self._last_seen
+        self._last_seen[user_id] = time.monotonic()
+        moved = replica_router.take_reload(user_id)
+        if (known and not moved) or user_id in self._pending_users:
+            return
+        async with get_pool().connection() as conn, conn.cursor() as cur:
+            await cur.execute("SELECT data FROM bot_user_data WHERE user_id = %s;", (user_id,))
+            row = await cur.fetchone()
+        user_data.clear()
+        if row is not None:
+            user_data.update(row["data"])
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    async def flush(self) -> None:
+        if self._write_task is not None:
+            await self._write_task
+        await self._write()
+
+    def _schedule_write(self) -> None:
+        # Le chiamate dello stesso giro di update_persistence confluiscono in una sola scrittura
+        if self._write_task is None or self._write_task.done():
+            self._write_task = asyncio.create_task(self._write_soon())
+
+    async def _write_soon(self) -> None:
+        await asyncio.sleep(0)
+        try:
+            await self._write()
+        except Exception as e:
+            logger.error("Errore nel salvataggio dello stato persistente: %s", e)
+
+    async def _write(self) -> None:
+        async with self._write_lock:
+            await self._write_pending()
+
+    async def _write_pending(self) -> None:
+        users, self._pending_users = self._pending_users, {}
+        conversations, self._pending_conversations = self._pending_conversations, {}
+        if not users and not conversations:
+            return
+        upserts = [(uid, Jsonb(data)) for uid, data in users.items() if data]
+        deletes = [uid for uid, data in users.items() if not data]
+        conv_upserts = [(name, key, Jsonb(state)) for (name, key), state in conversations.items() if state is not None]
+        conv_deletes = [(name, key) for (name, key), state in conversations.items() if state is None]
+        try:
+            async with get_pool().connection() as conn, conn.cursor() as cur:
+                if upserts:
+                    await cur.executemany(
+                        """
+                        INSERT INTO bot_user_data (user_id, data, updated_at)
+                        VALUES (%s, %s, NOW())
+                        ON CONFLICT (user_id) DO UPDATE
+                        SET data = EXCLUDED.data, updated_at = EXCLUDED.updated_at;
+                        """,
+                        upserts,
+                    )
+                if deletes:
+                    await cur.execute("DELETE FROM bot_user_data WHERE user_id = ANY(%s);", (deletes,))
+                if conv_upserts:
+                    await cur.executemany(
+                        """
+                        INSERT INTO bot_conversations (name, key, state, updated_at)
+                        VALUES (%s, %s, %s, NOW())
+                        ON CONFLICT (name, key) DO UPDATE
+                        SET state = EXCLUDED.state, updated_at = EXCLUDED.updated_at;
+                        """,
+                        conv_upserts,
+                    )
+                if conv_deletes:
+                    await cur.executemany(
+                        "DELETE FROM bot_conversations WHERE name = %s AND key = %s;",
+                        conv_deletes,
+                    )
+        except Exception:
+            # La transazione è annullata, quindi non è stato scritto niente: lo stato torna
+            # in coda per il prossimo salvataggio, senza coprire quello arrivato nel frattempo
+            for uid, data in users.items():
+                self._pending_users.setdefault(uid, data)
+            for key, state in conversations.items():
+                self._pending_conversations.setdefault(key, state)
+            raise
+
+    async def expire(self) -> List[int]:
+        # Rimuove dal database gli stati abbandonati e restituisce gli utenti rimossi
+        async with get_pool().connection() as conn, conn.cursor() as cur:
+            await cur.execute(
+                """
+                DELETE FROM bot_conversations
+                WHERE updated_at < NOW() - %s * interval '1 second';
+                """,
+                (self.ttl,),
+            )
+            await cur.execute(
+                """
+                DELETE FROM bot_user_data
+                WHERE updated_at < NOW() - %s * interval '1 second'
+                RETURNING user_id;
+                """,
+                (self.ttl,),
+            )
+            return [row["user_id"] for row in await cur.fetchall()]
+
+
+# ---------- Pulizia messaggi ----------
+
+def track_message(context: ContextTypes.DEFAULT_TYPE, flow: str, message_id: int) -> None:
+    # Ogni rito tiene la propria lista di messaggi da cancellare a fine processo
+    context.user_data.setdefault("cleanup", {}).setdefault(flow, []).append(message_id)
+
+
+def schedule_cleanup(context: ContextTypes.DEFAULT_TYPE, chat_id: int, flow: str) -> None:
+    # La cancellazione avviene in background, fuori dal percorso della risposta
+    message_ids = context.user_data.get("cleanup", {}).pop(flow, [])
+    if message_ids:
+        context.application.create_task(delete_messages(context.bot, chat_id, message_ids))
+
+
+async def delete_messages(bot: Bot, chat_id: int, message_ids: List[int]) -> None:
+    # deleteMessages accetta fino a 100 messaggi per chiamata
+    for start in range(0, len(message_ids), 100):
+        chunk = message_ids[start:start + 100]
+        try:
+            await bot.delete_messages(chat_id=chat_id, message_ids=chunk)
+            continue
+        except Exception as e:
+            logger.warning("Cancellazione multipla fallita, procedo singolarmente: %s", e)
+
+        semaphore = asyncio.Semaphore(CLEANUP_CONCURRENCY)
+
+        async def delete_one(mid: int) -> None:
+            async with semaphore:
+                try:
+                    await bot.delete_message(chat_id=chat_id, message_id=mid)
+                except Exception as e:
+                    logger.warning("Impossibile cancellare messaggio %s: %s", mid, e)
+
+        await asyncio.gather(*(delete_one(mid) for mid in chunk))
 
 
 # ---------- Ruoli ----------
 
+ROLE_NAMES = {"eremita": "hermit", "iniziato": "initiate"}
+
+
+class RoleRegistry:
+    # Indice in memoria della tabella roles. Fino al primo caricamento valgono
+    # HEREMITS_IDS/INITIATES_IDS; poi si ricarica a ogni NOTIFY roles_changed
+    # e comunque ogni ROLE_REFRESH_INTERVAL secondi.
+
+    def __init__(self) -> None:
+        self.hermits = set(HEREMITS_IDS)
+        self.initiates = set(INITIATES_IDS)
+        self._refresh_task: Optional[asyncio.Task] = None
+
+    def get(self, user_id: int) -> Optional[str]:
+        if user_id in self.hermits:
+            return "hermit"
+        if user_id in self.initiates:
+            return "initiate"
+        return None
+
+    async def refresh(self) -> None:
+        async with get_pool().connection() as conn, conn.cursor() as cur:
+            await cur.execute("SELECT user_id, role FROM roles;")
+            rows = await cur.fetchall()
+        # Sostituzione in blocco: get() non vede mai un indice a metà
+        self.hermits = {r["user_id"] for r in rows if r["role"] == "hermit"}
+        self.initiates = {r["user_id"] for r in rows if r["role"] == "initiate"}
+
+    def request_refresh(self, payload: str = "") -> None:
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._safe_refresh())
+
+    async def _safe_refresh(self) -> None:
+        try:
+            await self.refresh()
+        except Exception as e:
+            logger.error("Errore nel ricaricare i ruoli: %s", e)
+
+
+role_registry = RoleRegistry()
+db_listener.subscribe("roles_changed", role_registry.request_refresh)
+db_listener.on_connect(role_registry.request_refresh)
+
+
+@observe_db
+async def db_grant_role(user_id: int, role: str, granted_by: int) -> None:
+    async with get_pool().connection() as conn, conn.cursor() as cur:
+        await cur.execute(
+            """
+            INSERT INTO roles (user_id, role, granted_by)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (user_id) DO UPDATE
+            SET role = EXCLUDED.role, granted_by = EXCLUDED.granted_by, granted_at = NOW();
+            """,
+            (user_id, role, granted_by),
+        )
+
+
+@observe_db
+async def db_revoke_role(user_id: int) -> Optional[str]:
+    async with get_pool().connection() as conn, conn.cursor() as cur:
+        await cur.execute("DELETE FROM roles WHERE user_id = %s RETURNING role;", (user_id,))
+        row = await cur.fetchone()
+        return row["role"] if row else None
+
+
 def get_role(user_id: int) -> Optional[str]:
-    if user_id in HEREMITS_IDS:
-        return "hermit"
-    if user_id in INITIATES_IDS:
-        return "initiate"
-    return None
+    return role_registry.get(user_id)
 
 
 async def ensure_authorized(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Optional[str]:
@@ -140,6 +2074,146 @@ async def ensure_authorized(update: Update, context: ContextTypes.DEFAULT_TYPE)
     return role
 
 
+# ---------- Limitazione richieste ----------
+
+# Comandi e callback consentiti anche a chi non ha un ruolo
+PUBLIC_COMMANDS = {"start", "modulomensa"}
+PUBLIC_CALLBACK_PREFIXES = ("mensa_",)
+
+
+class RateLimiter:
+    # Token bucket in memoria per (utente, comando): ogni bucket contiene al massimo
+    # burst gettoni e se ne ricarica rate al secondo. Oltre max_keys si scartano
+    # i bucket usati meno di recente, che sarebbero comunque pieni.
+
+    def __init__(self, max_keys: int = 10000) -> None:
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[tuple, Tuple[float, float]]" = OrderedDict()
+
+    def allow(self, key: tuple, burst: int, rate: float) -> bool:
+        now = time.monotonic()
+        tokens, last = self._buckets.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - last) * rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self._buckets[key] = (tokens, now)
+        self._buckets.move_to_end(key)
+        while len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        return allowed
+
+
+rate_limiter = RateLimiter()
+
+
+def update_command(update: Update) -> Optional[str]:
+    message = update.message
+    if message is None or not message.text or not message.text.startswith("/"):
+        return None
+    return message.text.split(maxsplit=1)[0][1:].split("@", 1)[0].lower()
+
+
+def admit_update(update: object) -> bool:
+    # Chiamata dal processore degli update prima di ogni lock, lettura di stato o
+    # handler: usa solo dati in memoria, così un flood non arriva mai al database,
+    # alle API di Telegram né ai posti di elaborazione concorrente
+    if not isinstance(update, Update):
+        return True
+    user = update.effective_user
+    if user is None:
+        return True
+
+    command = update_command(update)
+    if get_role(user.id) is None:
+        query = update.callback_query
+        if (command is not None and command not in PUBLIC_COMMANDS) or (
+            query is not None and not (query.data or "").startswith(PUBLIC_CALLBACK_PREFIXES)
+        ):
+            THROTTLED_UPDATES.labels("non_autorizzato").inc()
+            return False
+
+    if command is not None:
+        allowed = rate_limiter.allow(
+            (user.id, command), RATE_LIMIT_COMMAND_BURST, RATE_LIMIT_COMMAND_RATE
+        )
+    else:
+        allowed = rate_limiter.allow(
+            (user.id, None), RATE_LIMIT_UPDATE_BURST, RATE_LIMIT_UPDATE_RATE
+        )
+    if not allowed:
+        THROTTLED_UPDATES.labels("limite").inc()
+        logger.debug("Update di %s scartato: limite di richieste superato", user.id)
+    return allowed
+
+
+# ---------- Callback idempotenti ----------
+
+class CallbackDeduplicator:
+    # Callback in corso o concluse da meno di ttl secondi, per (utente, chat, messaggio, dati):
+    # un secondo tocco sullo stesso pulsante aspetta il primo e non rifà nulla.
+    # Come nel RateLimiter, oltre max_keys si dimenticano le voci più vecchie.
+
+    def __init__(self, ttl: float, max_keys: int = 10000) -> None:
+        self.ttl = ttl
+        self.max_keys = max_keys
+        # chiave -> future della callback in corso, oppure scadenza di quella conclusa
+        self._entries: "OrderedDict[tuple, object]" = OrderedDict()
+
+    async def run(self, key: tuple, call: Callable[[], Awaitable]) -> bool:
+        # False se la callback era un duplicato e non è stata eseguita
+        entry = self._entries.get(key)
+        if isinstance(entry, asyncio.Future):
+            await asyncio.shield(entry)
+            return False
+        if entry is not None and entry >= time.monotonic():
+            return False
+
+        future = asyncio.get_running_loop().create_future()
+        self._entries[key] = future
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_keys:
+            self._entries.popitem(last=False)
+        try:
+            await call()
+        except BaseException:
+            # Se la prima esecuzione fallisce, un nuovo tocco deve poter riprovare
+            if self._entries.get(key) is future:
+                del self._entries[key]
+            raise
+        else:
+            if key in self._entries:
+                self._entries[key] = time.monotonic() + self.ttl
+        finally:
+            future.set_result(None)
+        return True
+
+
+callback_deduplicator = CallbackDeduplicator(CALLBACK_DEDUP_TTL)
+
+
+def idempotent_callback(*actions: str):
+    # Le callback il cui data inizia con uno di actions vengono eseguite una volta sola
+    # per messaggio: vanno usate per i pulsanti che chiudono il rito (conferme e annulli)
+    def decorator(handler):
+        @wraps(handler)
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            query = update.callback_query
+            if query.message is None or not (query.data or "").startswith(actions):
+                return await handler(update, context)
+
+            key = (query.from_user.id, query.message.chat.id, query.message.message_id, query.data)
+            if not await callback_deduplicator.run(key, lambda: handler(update, context)):
+                DUPLICATE_CALLBACKS.inc()
+                logger.debug("Callback %s di %s ignorata: duplicato", query.data, query.from_user.id)
+                await query.answer()
+            return None
+
+        return wrapper
+
+    return decorator
+
+
 # ---------- /start ----------
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -152,8 +2226,15 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             "🌊 Benvenuto, eremita.\n"
             "Questa breve guida ti aiuterà nelle tue mansioni all'interno del monastero! Qui sotto sono reportati i comandi a cui hai accesso.\n\n"
             "• /generacodice – <i>Genera un nuovo codice per un fedele</i>\n"
+            "• /generacodici – <i>Genera più codici in una volta sola</i>\n"
             "• /controllacodice – <i>Controlla o estingui un codice esistente</i>\n"
-            "• /modulomensa –<i>Inizia la registrazione di un modulo mensa</i>\n\n"
+            "• /cercafedele – <i>Cerca i codici di un fedele per nickname</i>\n"
+            "• /storicomensa – <i>Consulta i moduli mensa di un fedele</i>\n"
+            "• /modulomensa –<i>Inizia la registrazione di un modulo mensa</i>\n"
+            "• /concediruolo – <i>Concedi il ruolo di eremita o iniziato</i>\n"
+            "• /revocaruolo – <i>Revoca il ruolo a un utente</i>\n"
+            "• /esporta – <i>Esporta codici o moduli mensa in CSV</i>\n"
+            "• /report – <i>Report mensa su un periodo a scelta</i>\n\n"
             "Inoltre, per aiutarti in tutte le tue mansioni, qui sotto troverai il link per accedere alla guida dell'eremita.\n»https://telegra.ph/Guida-per-gli-Eremiti-02-02",
             parse_mode="HTML"
         )
@@ -165,7 +2246,10 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             "Il Monastero riconosce la tua appartenenza.\n\n"
             "Questa breve guida ti aiuterà nelle tue mansioni all'interno del monastero! Qui sotto sono reportati i comandi a cui hai accesso.\n\n"
             "• /generacodice – <i>Genera un nuovo codice per un fedele</i>\n"
+            "• /generacodici – <i>Genera più codici in una volta sola</i>\n"
             "• /controllacodice – <i>Controlla o estingui un codice esistente</i>\n"
+            "• /cercafedele – <i>Cerca i codici di un fedele per nickname</i>\n"
+            "• /storicomensa – <i>Consulta i moduli mensa di un fedele</i>\n"
             "• /modulomensa –<i>Inizia la registrazione di un modulo mensa</i>\n\nPer qualsiasi dubbio rivolgiti alla direzione del Monastero.",
             parse_mode="HTML"
         )
@@ -180,6 +2264,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
 # ---------- /generacodice ----------
 
+@observe_handler
 async def generacodice_entry(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if update.effective_chat.type != "private":
         return ConversationHandler.END
@@ -187,11 +2272,24 @@ async def generacodice_entry(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if role not in ["hermit", "initiate"]:
         return ConversationHandler.END
 
-    # Genera codice univoco
-    code = await asyncio.to_thread(generate_unique_code)
+    # Libera un'eventuale prenotazione rimasta da un rito precedente
+    user = update.effective_user
+    previous = context.user_data.pop("gen_code", None)
+    if previous:
+        await db_release_code(previous, user.id)
+
+    # Prenota un codice univoco
+    code = await db_reserve_code(user.id)
+    if code is None:
+        await update.message.reply_text(
+            "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
+            "⚠️ Non ci sono più codici sacri disponibili.\n"
+            "Rivolgiti alla direzione del Monastero.",
+            parse_mode="HTML"
+        )
+        return ConversationHandler.END
 
     context.user_data["gen_code"] = code
-    context.user_data["gen_messages_to_delete"] = []
 
     msg = await update.message.reply_text(
         "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
@@ -199,12 +2297,13 @@ async def generacodice_entry(update: Update, context: ContextTypes.DEFAULT_TYPE)
         "Ora inviami il <b>nickname del fedele</b> a cui deve essere assegnato.",
         parse_mode="HTML"
     )
-    context.user_data["gen_messages_to_delete"].append(msg.message_id)
-    context.user_data["gen_messages_to_delete"].append(update.message.message_id)
+    track_message(context, "gen", msg.message_id)
+    track_message(context, "gen", update.message.message_id)
 
     return GEN_GET_NICK
 
 
+@observe_handler
 async def generacodice_get_nick(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     role = get_role(update.effective_user.id)
     if role not in ["hermit", "initiate"]:
@@ -218,25 +2317,28 @@ async def generacodice_get_nick(update: Update, context: ContextTypes.DEFAULT_TY
     nick = update.message.text.strip()
     code = context.user_data.get("gen_code")
 
-    if not code:
+    if not code:
+        await update.message.reply_text(
+            "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
+            "⚠️ Qualcosa è andato storto.\n"
+            "Riprova il rito con /generacodice.",
+            parse_mode="HTML"
+        )
+        return ConversationHandler.END
+
+    # La prenotazione resta valida fino alla conferma o all'annullamento
+    if not await db_renew_reservation(code, update.effective_user.id):
+        context.user_data.pop("gen_code", None)
         await update.message.reply_text(
             "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
-            "⚠️ Qualcosa è andato storto.\n"
+            "⚠️ La prenotazione del codice è scaduta.\n"
             "Riprova il rito con /generacodice.",
             parse_mode="HTML"
         )
         return ConversationHandler.END
 
     context.user_data["gen_owner"] = nick
-    context.user_data["gen_messages_to_delete"].append(update.message.message_id)
-
-    # Cancella tutti i messaggi del processo
-    chat_id = update.effective_chat.id
-    for mid in context.user_data.get("gen_messages_to_delete", []):
-        try:
-            await context.bot.delete_message(chat_id=chat_id, message_id=mid)
-        except Exception as e:
-            logger.warning("Impossibile cancellare messaggio %s: %s", mid, e)
+    track_message(context, "gen", update.message.message_id)
 
     # Invia resoconto con bottoni
     text = (
@@ -260,9 +2362,21 @@ async def generacodice_get_nick(update: Update, context: ContextTypes.DEFAULT_TY
     msg = await update.effective_chat.send_message(text, reply_markup=keyboard, parse_mode="HTML")
     context.user_data["gen_summary_message_id"] = msg.message_id
 
+    # Cancella tutti i messaggi del processo
+    schedule_cleanup(context, update.effective_chat.id, "gen")
+
     return ConversationHandler.END
 
 
+async def generacodice_timeout(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Il fedele non è mai arrivato: il codice torna disponibile
+    code = context.user_data.pop("gen_code", None)
+    if code:
+        await db_release_code(code, update.effective_user.id)
+
+
+@observe_handler
+@idempotent_callback("gen_confirm", "gen_cancel")
 async def generacodice_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
@@ -287,6 +2401,8 @@ async def generacodice_callback(update: Update, context: ContextTypes.DEFAULT_TY
             "❌ Richiesta annullata.",
             parse_mode="HTML"
         )
+        if code:
+            await db_release_code(code, user.id)
         context.user_data.pop("gen_code", None)
         context.user_data.pop("gen_owner", None)
         return
@@ -301,12 +2417,12 @@ async def generacodice_callback(update: Update, context: ContextTypes.DEFAULT_TY
             )
             return
 
-        # Salva su DB (controllando ancora unicità)
-        existing = await asyncio.to_thread(db_get_code, code)
-        if existing is not None:
+        # Salva su DB consumando la prenotazione
+        row = await db_insert_code(code, owner, user.id)
+        if row is None:
             await query.edit_message_text(
                 "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
-                "⚠️ Il codice generato esiste già.\n"
+                "⚠️ La prenotazione del codice è scaduta.\n"
                 "Riprova il rito con /generacodice.",
                 parse_mode="HTML"
             )
@@ -314,8 +2430,6 @@ async def generacodice_callback(update: Update, context: ContextTypes.DEFAULT_TY
             context.user_data.pop("gen_owner", None)
             return
 
-        row = await asyncio.to_thread(db_insert_code, code, owner, user.id)
-
         # Messaggio finale all'eremita
         text = (
             "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
@@ -338,22 +2452,312 @@ async def generacodice_callback(update: Update, context: ContextTypes.DEFAULT_TY
             f"• 🕰️ Orario: <b>{row['created_at']}</b>"
         )
 
-        try:
-            await context.bot.send_message(
-                chat_id=DIRECTION_CHAT_ID,
-                text=dir_text,
-                message_thread_id=299,
-                parse_mode="HTML"
-            )
-        except Exception as e:
-            logger.error("Errore invio messaggio direzione: %s", e)
+        await notifier.enqueue(dir_text, CODES_THREAD_ID)
 
         # Pulisci dati temporanei
         context.user_data.pop("gen_code", None)
         context.user_data.pop("gen_owner", None)
 
+# ---------- /generacodici ----------
+
+def parse_nicknames(text: str, csv_file: bool = False) -> List[str]:
+    # Un nickname per riga oppure separati da virgole, anche su più righe.
+    # Nei file .csv invece conta solo la prima colonna di ogni riga.
+    lines = [line for line in text.splitlines() if line.strip()]
+    if csv_file:
+        lines = [row[0] if row else "" for row in csv.reader(lines)]
+    else:
+        lines = [nick for line in lines for nick in line.split(",")]
+    nicknames = []
+    seen = set()
+    for nick in (line.strip() for line in lines):
+        if nick and nick.lower() not in seen:
+            seen.add(nick.lower())
+            nicknames.append(nick)
+    return nicknames
+
+
+async def generacodici_preview(update: Update, context: ContextTypes.DEFAULT_TYPE, nicknames: List[str]) -> int:
+    if not nicknames:
+        await update.message.reply_text(
+            "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
+            "⚠️ Non ho trovato nessun nickname.\n"
+            "Inviami un nickname per riga oppure un file .txt/.csv.",
+            parse_mode="HTML"
+        )
+        return BULK_GET_LIST
+
+    if len(nicknames) > BULK_MAX_CODES:
+        await update.message.reply_text(
+            "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
+            f"⚠️ Puoi generare al massimo <b>{BULK_MAX_CODES}</b> codici per volta "
+            f"(ne hai indicati {len(nicknames)}).",
+            parse_mode="HTML"
+        )
+        return BULK_GET_LIST
+
+    context.user_data["bulk_owners"] = nicknames
+    preview = "\n".join(f"• {html.escape(nick)}" for nick in nicknames[:20])
+    if len(nicknames) > 20:
+        preview += f"\n… e altri {len(nicknames) - 20}"
+
+    keyboard = InlineKeyboardMarkup(
+        [
+            [
+                InlineKeyboardButton("✅ Conferma", callback_data="bulk_confirm"),
+                InlineKeyboardButton("❌ Annulla", callback_data="bulk_cancel"),
+            ]
+        ]
+    )
+    await update.effective_chat.send_message(
+        "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
+        "📋 <b>Riepilogo generazione multipla</b>\n\n"
+        f"Verranno generati <b>{len(nicknames)}</b> codici per:\n\n{preview}",
+        reply_markup=keyboard,
+        parse_mode="HTML"
+    )
+    return ConversationHandler.END
+
+
+@observe_handler
+async def generacodici_entry(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    if update.effective_chat.type != "private":
+        return ConversationHandler.END
+    role = await ensure_authorized(update, context)
+    if role not in ["hermit", "initiate"]:
+        return ConversationHandler.END
+
+    # La lista può seguire direttamente il comando
+    parts = update.message.text.split(maxsplit=1)
+    if len(parts) == 2:
+        return await generacodici_preview(update, context, parse_nicknames(parts[1]))
+
+    await update.message.reply_text(
+        "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
+        "🔱 Inviami i <b>nickname dei fedeli</b>, uno per riga, "
+        "oppure carica un file <b>.txt</b> o <b>.csv</b>.",
+        parse_mode="HTML"
+    )
+    return BULK_GET_LIST
+
+
+@observe_handler
+async def generacodici_get_list(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    if get_role(update.effective_user.id) not in ["hermit", "initiate"]:
+        return ConversationHandler.END
+
+    document = update.message.document
+    if document is None:
+        return await generacodici_preview(update, context, parse_nicknames(update.message.text))
+
+    if document.file_size and document.file_size > BULK_MAX_FILE_SIZE:
+        await update.message.reply_text(
+            "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
+            "⚠️ Il file è troppo grande.",
+            parse_mode="HTML"
+        )
+        return BULK_GET_LIST
+
+    file = await document.get_file()
+    content = await file.download_as_bytearray()
+    try:
+        text = bytes(content).decode("utf-8-sig")
+    except UnicodeDecodeError:
+        await update.message.reply_text(
+            "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
+            "⚠️ Il file deve essere un testo in UTF-8.",
+            parse_mode="HTML"
+        )
+        return BULK_GET_LIST
+    csv_file = (document.file_name or "").lower().endswith(".csv") or document.mime_type == "text/csv"
+    return await generacodici_preview(update, context, parse_nicknames(text, csv_file))
+
+
+@observe_handler
+@idempotent_callback("bulk_")
+async def generacodici_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    await query.answer()
+
+    user = query.from_user
+    if get_role(user.id) not in ["hermit", "initiate"]:
+        await query.edit_message_text(
+            "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
+            "⛔ Non sei autorizzato.",
+            parse_mode="HTML"
+        )
+        return
+
+    owners = context.user_data.pop("bulk_owners", None)
+
+    if query.data == "bulk_cancel":
+        await query.edit_message_text(
+            "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
+            "❌ Richiesta annullata.",
+            parse_mode="HTML"
+        )
+        return
+
+    if not owners:
+        await query.edit_message_text(
+            "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
+            "⚠️ Dati mancanti.\n"
+            "Riprova il rito con /generacodici.",
+            parse_mode="HTML"
+        )
+        return
+
+    rows = await db_insert_codes_bulk(owners, user.id)
+    if rows is None:
+        await query.edit_message_text(
+            "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
+            f"⚠️ Non ci sono abbastanza codici liberi per {len(owners)} fedeli.\n"
+            "Nessun codice è stato generato.",
+            parse_mode="HTML"
+        )
+        return
+
+    await query.edit_message_text(
+        "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
+        f"✅ <b>{len(rows)} codici creati con successo!</b>\n\n"
+        "Trovi l'elenco completo nel file qui sotto.",
+        parse_mode="HTML"
+    )
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(["id", "codice", "fedele", "creato_alle"])
+    for row in rows:
+        writer.writerow([row["id"], row["code"], row["owner"], row["created_at"].isoformat()])
+    await query.message.chat.send_document(
+        document=buffer.getvalue().encode("utf-8"),
+        filename=f"codici_{datetime.date.today().isoformat()}.csv",
+    )
+
+    # Un'unica notifica riepilogativa per il gruppo direzione
+    header = (
+        f"<b>📜 {len(rows)} NUOVI CODICI GENERATI</b>\n\n"
+        f"• 🧙‍♂️ Creati da: <b>{html.escape(user.full_name)}</b> (ID {user.id})\n\n"
+    )
+    lines = [f"• 🔐 <b>{row['code']}</b> – {html.escape(row['owner'])}\n" for row in rows]
+    await notifier.enqueue(join_within_limit(header, lines), CODES_THREAD_ID, digest=False)
+
+
+# ---------- /cercafedele ----------
+
+def format_search_page(prefix: str, rows: List[dict], has_prev: bool, has_next: bool) -> Tuple[str, InlineKeyboardMarkup]:
+    if not rows:
+        text = (
+            "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
+            f"❌ Nessun codice trovato per <b>{html.escape(prefix)}</b>."
+        )
+    else:
+        lines = []
+        for row in rows:
+            status = "🟢" if row["active"] else "🔴"
+            lines.append(
+                f"{status} <b>{row['code']}</b> – {html.escape(row['owner'])} "
+                f"<i>({row['created_at']:%d/%m/%Y})</i>"
+            )
+        text = (
+            "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
+            f"🔎 <b>Fedeli che iniziano per {html.escape(prefix)}</b>\n\n" + "\n".join(lines)
+        )
+
+    nav = []
+    if has_prev:
+        nav.append(InlineKeyboardButton("⬅️ Precedenti", callback_data="search_prev"))
+    if has_next:
+        nav.append(InlineKeyboardButton("Successivi ➡️", callback_data="search_next"))
+    keyboard = [nav] if nav else []
+    keyboard.append([InlineKeyboardButton("Chiudi", callback_data="search_close")])
+    return text, InlineKeyboardMarkup(keyboard)
+
+
+def remember_search_page(context: ContextTypes.DEFAULT_TYPE, prefix: str, rows: List[dict]) -> None:
+    # Il cursore della pagina corrente: prima e ultima chiave (lower(owner), id)
+    context.user_data["search"] = {
+        "prefix": prefix,
+        "first": [rows[0]["owner_key"], rows[0]["id"]] if rows else None,
+        "last": [rows[-1]["owner_key"], rows[-1]["id"]] if rows else None,
+    }
+
+
+@observe_handler
+async def cercafedele(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_chat.type != "private":
+        return
+    role = await ensure_authorized(update, context)
+    if role not in ["hermit", "initiate"]:
+        return
+
+    prefix = " ".join(context.args or []).strip()
+    if not prefix:
+        await update.message.reply_text(
+            "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
+            "ℹ️ Uso: <code>/cercafedele &lt;nickname o parte iniziale&gt;</code>",
+            parse_mode="HTML"
+        )
+        return
+
+    rows = await db_search_codes(prefix, limit=SEARCH_PAGE_SIZE + 1)
+    has_next = len(rows) > SEARCH_PAGE_SIZE
+    rows = rows[:SEARCH_PAGE_SIZE]
+    remember_search_page(context, prefix, rows)
+    text, keyboard = format_search_page(prefix, rows, False, has_next)
+    await update.message.reply_text(text, reply_markup=keyboard, parse_mode="HTML")
+
+
+@observe_handler
+async def cercafedele_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    await query.answer()
+
+    if get_role(query.from_user.id) not in ["hermit", "initiate"]:
+        await query.edit_message_text(
+            "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
+            "⛔ Non sei autorizzato.",
+            parse_mode="HTML"
+        )
+        return
+
+    search = context.user_data.get("search")
+    if query.data == "search_close" or not search or not search["first"]:
+        context.user_data.pop("search", None)
+        await query.edit_message_text(
+            "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
+            "🔚 Ricerca conclusa.",
+            parse_mode="HTML"
+        )
+        return
+
+    prefix = search["prefix"]
+    if query.data == "search_prev":
+        rows = await db_search_codes(prefix, before=search["first"], limit=SEARCH_PAGE_SIZE + 1)
+        has_prev = len(rows) > SEARCH_PAGE_SIZE
+        rows = rows[-SEARCH_PAGE_SIZE:]
+        has_next = True
+    else:
+        rows = await db_search_codes(prefix, after=search["last"], limit=SEARCH_PAGE_SIZE + 1)
+        has_next = len(rows) > SEARCH_PAGE_SIZE
+        rows = rows[:SEARCH_PAGE_SIZE]
+        has_prev = True
+
+    if not rows:
+        # Le righe ai bordi sono state cancellate nel frattempo: ricomincia dall'inizio
+        rows = await db_search_codes(prefix, limit=SEARCH_PAGE_SIZE + 1)
+        has_next = len(rows) > SEARCH_PAGE_SIZE
+        rows = rows[:SEARCH_PAGE_SIZE]
+        has_prev = False
+
+    remember_search_page(context, prefix, rows)
+    text, keyboard = format_search_page(prefix, rows, has_prev, has_next)
+    await query.edit_message_text(text, reply_markup=keyboard, parse_mode="HTML")
+
+
 # ---------- /controllacodice ----------
 
+@observe_handler
 async def controllacodice_entry(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if update.effective_chat.type != "private":
         return ConversationHandler.END
@@ -363,7 +2767,8 @@ async def controllacodice_entry(update: Update, context: ContextTypes.DEFAULT_TY
 
     msg = await update.message.reply_text(
         "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
-        "🔍 Inserisci il <b>codice sacro</b> (4 cifre) che desideri verificare.",
+        "🔍 Inserisci il <b>codice sacro</b> (4 cifre) che desideri verificare.\n"
+        "Puoi inviarne anche più di uno, separati da spazi o a capo.",
         parse_mode="HTML"
     )
     context.user_data["check_prompt_message_id"] = msg.message_id
@@ -371,6 +2776,7 @@ async def controllacodice_entry(update: Update, context: ContextTypes.DEFAULT_TY
     return CHECK_GET_CODE
 
 
+@observe_handler
 async def controllacodice_get_code(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user = update.effective_user
     role = get_role(user.id)
@@ -382,22 +2788,35 @@ async def controllacodice_get_code(update: Update, context: ContextTypes.DEFAULT
         )
         return ConversationHandler.END
 
-    code = update.message.text.strip()
+    codes = parse_codes(update.message.text)
     chat_id = update.effective_chat.id
 
     # Elimina il messaggio dell'utente
-    try:
-        await context.bot.delete_message(chat_id=chat_id, message_id=update.message.message_id)
-    except Exception as e:
-        logger.warning("Impossibile cancellare messaggio utente: %s", e)
+    track_message(context, "check", update.message.message_id)
+    schedule_cleanup(context, chat_id, "check")
+
+    if not codes:
+        # Solo virgole o spazi: il rito resta in attesa di un codice
+        reply = await update.message.reply_text(
+            "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
+            "❌ Nessun codice nel messaggio: invia il codice da controllare.",
+            parse_mode="HTML"
+        )
+        track_message(context, "check", reply.message_id)
+        return CHECK_GET_CODE
+
+    if len(codes) > 1:
+        return await controllacodice_batch(update, context, codes)
+
+    code = codes[0]
 
     # Recupera info codice
-    row = await asyncio.to_thread(db_get_code, code)
+    row = await db_get_code(code)
 
     if row is None:
         text = (
             "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
-            f"❌ Il codice <b>{code}</b> non è stato trovato o non è più attivo."
+            f"❌ Il codice <b>{html.escape(code)}</b> non è stato trovato o non è più attivo."
         )
         keyboard = InlineKeyboardMarkup(
             [[InlineKeyboardButton("Chiudi", callback_data="check_close")]]
@@ -460,6 +2879,86 @@ async def controllacodice_get_code(update: Update, context: ContextTypes.DEFAULT
     return ConversationHandler.END
 
 
+def parse_codes(text: str) -> List[str]:
+    codes = []
+    for code in text.replace(",", " ").split():
+        if code not in codes:
+            codes.append(code)
+    return codes
+
+
+def format_codes_table(codes: List[str], rows: Dict[str, dict]) -> Tuple[str, List[str]]:
+    # Tabella compatta in monospazio: codice, stato e fedele.
+    # Restituisce anche i codici ancora attivi.
+    lines = []
+    active = []
+    for code in codes:
+        row = rows.get(code)
+        if row is None:
+            status, owner = "—", ""
+        elif row["active"]:
+            status, owner = "ATTIVO", row["owner"]
+            active.append(code)
+        else:
+            status, owner = "ESTINTO", row["owner"]
+        if len(owner) > 16:
+            owner = owner[:15] + "…"
+        lines.append(html.escape(f"{code[:8]:<8} {status:<7} {owner}") + "\n")
+
+    found = sum(1 for code in codes if code in rows)
+    header = (
+        "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
+        f"📜 <b>Controllo di {len(codes)} codici</b>\n"
+        f"🟢 {len(active)} attivi · 🔴 {found - len(active)} estinti · "
+        f"❌ {len(codes) - found} non trovati\n\n<pre>"
+    )
+    return join_within_limit(header, lines, NotificationDispatcher.MAX_MESSAGE_LENGTH - 10) + "</pre>", active
+
+
+async def controllacodice_batch(update: Update, context: ContextTypes.DEFAULT_TYPE, codes: List[str]) -> int:
+    chat_id = update.effective_chat.id
+    prompt_id = context.user_data.get("check_prompt_message_id")
+
+    if len(codes) > CHECK_MAX_CODES:
+        text = (
+            "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
+            f"⚠️ Puoi controllare al massimo <b>{CHECK_MAX_CODES}</b> codici per volta "
+            f"(ne hai indicati {len(codes)})."
+        )
+        keyboard = InlineKeyboardMarkup(
+            [[InlineKeyboardButton("Chiudi", callback_data="check_close")]]
+        )
+    else:
+        # Tutti i codici con una sola query
+        rows = await db_get_codes(codes)
+        text, active = format_codes_table(codes, rows)
+        buttons = []
+        if active:
+            buttons.append(
+                InlineKeyboardButton(
+                    f"🔥 Estingui attivi ({len(active)})", callback_data="extinguish_all"
+                )
+            )
+        buttons.append(InlineKeyboardButton("❌ Chiudi", callback_data="check_close"))
+        keyboard = InlineKeyboardMarkup([buttons])
+        context.user_data["check_batch_codes"] = active
+
+    if prompt_id:
+        await context.bot.edit_message_text(
+            chat_id=chat_id,
+            message_id=prompt_id,
+            text=text,
+            reply_markup=keyboard,
+            parse_mode="HTML"
+        )
+    else:
+        msg = await update.effective_chat.send_message(text, reply_markup=keyboard, parse_mode="HTML")
+        context.user_data["check_prompt_message_id"] = msg.message_id
+    return ConversationHandler.END
+
+
+@observe_handler
+@idempotent_callback("check_close", "extinguish_confirm:", "extinguish_all_confirm")
 async def controllacodice_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
@@ -483,6 +2982,77 @@ async def controllacodice_callback(update: Update, context: ContextTypes.DEFAULT
             parse_mode="HTML"
         )
         context.user_data.pop("check_code", None)
+        context.user_data.pop("check_batch_codes", None)
+        return
+
+    if data == "extinguish_all":
+        codes = context.user_data.get("check_batch_codes")
+        if not codes:
+            await query.edit_message_text(
+                "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
+                "⚠️ Dati mancanti.\n"
+                "Riprova il rito con /controllacodice.",
+                parse_mode="HTML"
+            )
+            return
+
+        keyboard = InlineKeyboardMarkup(
+            [
+                [
+                    InlineKeyboardButton(
+                        "✅ Conferma estinzione", callback_data="extinguish_all_confirm"
+                    ),
+                    InlineKeyboardButton("❌ Annulla", callback_data="check_close"),
+                ]
+            ]
+        )
+        await query.edit_message_text(
+            "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
+            f"🔥 Sei sicuro di voler <b>estinguere {len(codes)} codici</b>?\n\n"
+            + html.escape(", ".join(codes)),
+            reply_markup=keyboard,
+            parse_mode="HTML"
+        )
+        return
+
+    if data == "extinguish_all_confirm":
+        codes = context.user_data.pop("check_batch_codes", None)
+        if not codes:
+            await query.edit_message_text(
+                "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
+                "⚠️ Dati mancanti.\n"
+                "Riprova il rito con /controllacodice.",
+                parse_mode="HTML"
+            )
+            return
+
+        rows = await db_extinguish_codes(codes)
+        if not rows:
+            await query.edit_message_text(
+                "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
+                "⚠️ Nessuno dei codici è ancora attivo.",
+                parse_mode="HTML"
+            )
+            return
+
+        text = (
+            "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
+            f"🔥 <b>{len(rows)} codici estinti con successo.</b>"
+        )
+        if len(rows) < len(codes):
+            text += f"\n\n⚠️ {len(codes) - len(rows)} non erano più attivi."
+        await query.edit_message_text(text, parse_mode="HTML")
+
+        # Un'unica notifica al gruppo direzione
+        header = (
+            f"<b>⚠️ {len(rows)} CODICI ESTINTI</b>\n\n"
+            f"• 🧙‍♂️ Estinti da: <b>{html.escape(user.full_name)}</b> (ID {user.id})\n\n"
+        )
+        lines = [
+            f"• 🔐 <b>{row['code']}</b> – {html.escape(row['owner'])} (ID {row['id']})\n"
+            for row in rows
+        ]
+        await notifier.enqueue(join_within_limit(header, lines), CODES_THREAD_ID, digest=False)
         return
 
     if data.startswith("extinguish:"):
@@ -509,7 +3079,7 @@ async def controllacodice_callback(update: Update, context: ContextTypes.DEFAULT
 
     if data.startswith("extinguish_confirm:"):
         code = data.split(":", 1)[1]
-        row = await asyncio.to_thread(db_extinguish_code, code)
+        row = await db_extinguish_code(code)
 
         if row is None:
             await query.edit_message_text(
@@ -539,19 +3109,12 @@ async def controllacodice_callback(update: Update, context: ContextTypes.DEFAULT
             f"• 🧙‍♂️ Estinto da: <b>{user.full_name}</b> (ID {user.id})"
         )
 
-        try:
-            await context.bot.send_message(
-                chat_id=DIRECTION_CHAT_ID,
-                text=dir_text,
-                message_thread_id=299,
-                parse_mode="HTML"
-            )
-        except Exception as e:
-            logger.error("Errore invio messaggio direzione: %s", e)
+        await notifier.enqueue(dir_text, CODES_THREAD_ID)
 
         context.user_data.pop("check_code", None)
 
 
+@observe_handler
 async def modulomensa_entry(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.type != "private":
         return ConversationHandler.END
@@ -568,20 +3131,23 @@ async def modulomensa_entry(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode="HTML"
     )
 
-    context.user_data["mensa_msg"] = msg
+    context.user_data["mensa_msg_id"] = msg.message_id
     return MOD_MENSA_NICK
 
 
 
+@observe_handler
 async def modulomensa_get_nick(update: Update, context: ContextTypes.DEFAULT_TYPE):
     nick = update.message.text.strip()
     context.user_data["mensa_nick"] = nick
 
-    await update.message.delete()
+    track_message(context, "mensa", update.message.message_id)
+    schedule_cleanup(context, update.effective_chat.id, "mensa")
 
-    msg = context.user_data["mensa_msg"]
-    await msg.edit_text(
-        "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
+    await context.bot.edit_message_text(
+        chat_id=update.effective_chat.id,
+        message_id=context.user_data["mensa_msg_id"],
+        text="<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
         "🍽️ Inserisci ora la <b>quantità di cibo</b> distribuita al fedele.\n\n"
         "Puoi indicare porzioni, sacchetti o una descrizione breve.",
         parse_mode="HTML"
@@ -591,23 +3157,32 @@ async def modulomensa_get_nick(update: Update, context: ContextTypes.DEFAULT_TYP
 
 
 
+@observe_handler
 async def modulomensa_get_qty(update: Update, context: ContextTypes.DEFAULT_TYPE):
     qty = update.message.text.strip()
     context.user_data["mensa_qty"] = qty
 
-    await update.message.delete()
+    track_message(context, "mensa", update.message.message_id)
+    schedule_cleanup(context, update.effective_chat.id, "mensa")
 
     nick = context.user_data["mensa_nick"]
     registratore = context.user_data["mensa_registratore_username"]
-    msg = context.user_data["mensa_msg"]
 
-    await msg.edit_text(
-        "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
+    value, unit = parse_quantity(qty)
+    if value is not None:
+        qty_note = f" <i>(letta come {html.escape(format_quantity(value, unit))})</i>"
+    else:
+        qty_note = "\n   ⚠️ <i>Quantità non riconosciuta: verrà salvata solo come testo.</i>"
+
+    await context.bot.edit_message_text(
+        chat_id=update.effective_chat.id,
+        message_id=context.user_data["mensa_msg_id"],
+        text="<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
         "📋 Sei arrivato alla fine della registrazione.\n\n"
         "Qui sotto trovi il <i>resoconto</i> delle informazioni inserite. "
         "Controlla che siano corrette e conferma il modulo:\n\n"
         f"• 👤 Fedele: <b>{nick}</b>\n"
-        f"• 🍽️ Quantità: <b>{qty}</b>\n"
+        f"• 🍽️ Quantità: <b>{qty}</b>{qty_note}\n"
         f"• 🧙‍♂️ Registrato da: <b>@{registratore}</b>\n\n"
         "Vuoi confermare la registrazione?",
         parse_mode="HTML",
@@ -621,6 +3196,7 @@ async def modulomensa_get_qty(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 
 
+@observe_handler
 async def modulomensa_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -639,22 +3215,32 @@ async def modulomensa_callback(update: Update, context: ContextTypes.DEFAULT_TYP
         registratore_id = context.user_data["mensa_registratore_id"]
         registratore_username = context.user_data["mensa_registratore_username"]
 
-        # Salvataggio nel DB
-        save_mensa_record(nick, qty, registratore_id, registratore_username)
+        # Salvataggio nel DB (la conferma arriva solo dopo il commit)
+        try:
+            await save_mensa_record(nick, qty, registratore_id, registratore_username)
+        except Exception as e:
+            logger.error("Errore salvataggio modulo mensa: %s", e)
+            await query.edit_message_text(
+                "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
+                "⚠️ Non è stato possibile registrare il modulo mensa.\n"
+                "Riprova con /modulomensa.",
+                parse_mode="HTML"
+            )
+            return ConversationHandler.END
 
-        # Invio nel gruppo direzione
-        await context.bot.send_message(
-            chat_id=DIRECTION_CHAT_ID,
-            text=(
+        # Invio nel gruppo direzione: il modulo è già salvato, quindi un errore qui
+        # non deve togliere la conferma all'utente
+        try:
+            await notifier.enqueue(
                 "<b>📜 NUOVA REGISTRAZIONE MENSA</b>\n\n"
                 f"• 👤 Fedele: <b>{nick}</b>\n"
                 f"• 🍽️ Quantità: <b>{qty}</b>\n"
                 f"• 🧙‍♂️ Registrato da: <b>@{registratore_username}</b> (ID: {registratore_id})\n"
-                f"• 🕰️ Data: <b>{datetime.datetime.now().strftime('%d/%m/%Y %H:%M')}</b>"
-            ),
-            parse_mode="HTML",
-            message_thread_id=297
-        )
+                f"• 🕰️ Data: <b>{datetime.datetime.now().strftime('%d/%m/%Y %H:%M')}</b>",
+                MENSA_THREAD_ID,
+            )
+        except Exception as e:
+            logger.error("Notifica del modulo mensa di %s non accodata: %s", nick, e)
 
         await query.edit_message_text(
             "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
@@ -666,86 +3252,1061 @@ async def modulomensa_callback(update: Update, context: ContextTypes.DEFAULT_TYP
 
 
 
-def save_mensa_record(nick, qty, registratore_id, registratore_username):
-    conn = psycopg.connect(DATABASE_URL)
-    cur = conn.cursor()
-    cur.execute(
-        """
-        INSERT INTO mensa (nickname, quantita, registratore_id, registratore_username, data)
-        VALUES (%s, %s, %s, %s, NOW())
-        """,
-        (nick, qty, registratore_id, registratore_username)
-    )
-    conn.commit()
-    cur.close()
-    conn.close()
-
-def get_weekly_mensa_report():
-    conn = psycopg.connect(DATABASE_URL)
-    cur = conn.cursor()
-
-    # Calcola l'intervallo della settimana precedente
-    cur.execute("""
-        SELECT 
-            date_trunc('week', NOW() - interval '1 week')::date AS start_date,
-            (date_trunc('week', NOW()) - interval '1 day')::date AS end_date
-    """)
-    start_date, end_date = cur.fetchone()
-
-    # Conteggio per registratore
-    cur.execute("""
-        SELECT registratore_username, COUNT(*)
-        FROM mensa
-        WHERE data::date BETWEEN %s AND %s
-        GROUP BY registratore_username
-        ORDER BY COUNT(*) DESC
-    """, (start_date, end_date))
-    rows = cur.fetchall()
+# Sinonimi delle unità più usate, ricondotti a un nome unico
+QUANTITY_UNITS = {
+    "porzione": "porzioni", "porzioni": "porzioni", "porz": "porzioni",
+    "pasto": "pasti", "pasti": "pasti",
+    "pezzo": "pezzi", "pezzi": "pezzi", "pz": "pezzi",
+    "kg": "kg", "chilo": "kg", "chili": "kg", "chilogrammi": "kg",
+    "g": "g", "gr": "g", "grammi": "g",
+    "l": "l", "lt": "l", "litro": "l", "litri": "l",
+}
+QUANTITY_WORDS = {
+    "un": 1, "uno": 1, "una": 1, "mezzo": Decimal("0.5"), "mezza": Decimal("0.5"),
+    "due": 2, "tre": 3, "quattro": 4, "cinque": 5,
+    "sei": 6, "sette": 7, "otto": 8, "nove": 9, "dieci": 10,
+}
+# Numeri ("2", "1,5", "1.5", "1.000", "1.000,5") e parole, in ordine di apparizione
+QUANTITY_TOKEN = re.compile(r"\d{1,3}(?:\.\d{3})+(?:,\d+)?(?!\d)|\d+(?:[.,]\d+)?|[^\W\d_]+")
+QUANTITY_THOUSANDS = re.compile(r"\d{1,3}(?:\.\d{3})+(?:,\d+)?")
+
+
+def parse_quantity(text: str) -> Tuple[Optional[Decimal], Optional[str]]:
+    # "2 porzioni", "porzioni 2", "1,5 kg", "250g", "due porzioni" -> (valore, unità).
+    # L'unità è la parola subito dopo il numero (o subito prima, se dopo non c'è niente)
+    # e deve essere tra QUANTITY_UNITS; un numero da solo conta in "unità".
+    # In ogni altro caso restituisce (None, None) e resta solo il testo.
+    tokens = QUANTITY_TOKEN.findall(text.lower())
+    if tokens and tokens[0] in QUANTITY_WORDS:
+        index, value = 0, Decimal(QUANTITY_WORDS[tokens[0]])
+    else:
+        index = next((i for i, token in enumerate(tokens) if token[0].isdigit()), None)
+        if index is None:
+            return None, None
+        number = tokens[index]
+        if QUANTITY_THOUSANDS.fullmatch(number):
+            number = number.replace(".", "")
+        value = Decimal(number.replace(",", "."))
+
+    if value <= 0:
+        return None, None
+    if index + 1 < len(tokens):
+        unit = QUANTITY_UNITS.get(tokens[index + 1])
+    elif index > 0:
+        unit = QUANTITY_UNITS.get(tokens[index - 1])
+    else:
+        unit = "unità"
+    if unit is None:
+        return None, None
+    return value, unit
+
+
+def format_quantity(value: Decimal, unit: str) -> str:
+    return f"{value.normalize():f}".replace(".", ",") + f" {unit}"
+
+
+class MensaWriter:
+    # Buffer write-behind per i moduli mensa: le righe vengono accumulate e scritte
+    # con un unico INSERT multi-riga al raggiungimento di MENSA_BATCH_SIZE righe
+    # o dopo MENSA_FLUSH_INTERVAL secondi, aggiornando nella stessa istruzione
+    # i riepiloghi giornalieri per registratore e per unità. Chi chiama add() attende il commit.
+
+    def __init__(self, batch_size: int, flush_interval: float) -> None:
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+
+    def start(self) -> None:
+        if self._task is None:
+            self._closing = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        # Scrive tutte le righe ancora in coda prima di chiudere
+        if self._task is None:
+            return
+        self._closing = True
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    async def add(self, row: tuple) -> None:
+        if self._task is None or self._closing:
+            raise RuntimeError("Il writer dei moduli mensa non è attivo.")
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((row, future))
+        await future
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._flush(batch)
+
+    @observe_db
+    async def _flush(self, batch: list) -> None:
+        columns = [list(column) for column in zip(*(row for row, _ in batch))]
+        try:
+            async with get_pool().connection() as conn, conn.cursor() as cur:
+                await cur.execute(
+                    """
+                    WITH inserted AS (
+                        INSERT INTO mensa (nickname, quantita, quantita_valore, quantita_unita,
+                                           registratore_id, registratore_username, data)
+                        SELECT nickname, quantita, quantita_valore, quantita_unita,
+                               registratore_id, registratore_username, NOW()
+                        FROM unnest(%s::text[], %s::text[], %s::numeric[], %s::text[],
+                                    %s::bigint[], %s::text[])
+                            AS t(nickname, quantita, quantita_valore, quantita_unita,
+                                 registratore_id, registratore_username)
+                        RETURNING data, registratore_username, quantita_valore, quantita_unita
+                    ),
+                    units AS (
+                        INSERT INTO mensa_daily_unita (giorno, unita, totale, moduli)
+                        SELECT data::date, quantita_unita, SUM(quantita_valore), COUNT(*)
+                        FROM inserted
+                        WHERE quantita_unita IS NOT NULL
+                        GROUP BY 1, 2
+                        ON CONFLICT (giorno, unita)
+                        DO UPDATE SET totale = mensa_daily_unita.totale + EXCLUDED.totale,
+                                      moduli = mensa_daily_unita.moduli + EXCLUDED.moduli
+                    )
+                    INSERT INTO mensa_daily (giorno, registratore_username, moduli)
+                    SELECT data::date, registratore_username, COUNT(*)
+                    FROM inserted
+                    GROUP BY 1, 2
+                    ON CONFLICT (giorno, registratore_username)
+                    DO UPDATE SET moduli = mensa_daily.moduli + EXCLUDED.moduli
+                    """,
+                    columns,
+                    prepare=True,
+                )
+        except Exception as e:
+            logger.error("Errore scrittura di %s moduli mensa: %s", len(batch), e)
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for _, future in batch:
+            if not future.done():
+                future.set_result(None)
+
+
+mensa_writer = MensaWriter(MENSA_BATCH_SIZE, MENSA_FLUSH_INTERVAL)
+
+
+@observe_db
+async def db_mensa_history(nickname: str, after: Optional[List] = None, before: Optional[List] = None,
+                           limit: int = HISTORY_PAGE_SIZE) -> List[dict]:
+    # Moduli di un fedele dal più recente, paginati per (data, id) su mensa_nickname_data_idx
+    if before is not None:
+        condition, order, params = "AND (data, id) > (%s, %s)", "ASC", [nickname, *before, limit]
+    elif after is not None:
+        condition, order, params = "AND (data, id) < (%s, %s)", "DESC", [nickname, *after, limit]
+    else:
+        condition, order, params = "", "DESC", [nickname, limit]
+
+    async with get_pool().connection() as conn, conn.cursor() as cur:
+        await cur.execute(
+            f"""
+            SELECT id, nickname, quantita, registratore_username, data FROM mensa
+            WHERE lower(nickname) = lower(%s) {condition}
+            ORDER BY data {order}, id {order}
+            LIMIT %s;
+            """,
+            params,
+        )
+        rows = await cur.fetchall()
+    if before is not None:
+        rows.reverse()
+    return rows
+
 
-    conn.close()
-    return start_date, end_date, rows
-def format_weekly_report(start_date, end_date, rows):
+@observe_db
+async def db_mensa_totals(nickname: str) -> dict:
+    async with get_pool().connection() as conn, conn.cursor() as cur:
+        await cur.execute(
+            """
+            SELECT count(*) AS moduli, min(data) AS primo, max(data) AS ultimo
+            FROM mensa
+            WHERE lower(nickname) = lower(%s);
+            """,
+            (nickname,),
+        )
+        return await cur.fetchone()
+
+
+@observe_db
+async def save_mensa_record(nick, qty, registratore_id, registratore_username):
+    value, unit = parse_quantity(qty)
+    await mensa_writer.add((nick, qty, value, unit, registratore_id, registratore_username))
+
+@observe_db
+async def get_weekly_mensa_report():
+    async with get_pool().connection() as conn, conn.cursor(row_factory=tuple_row) as cur:
+        # Calcola l'intervallo della settimana precedente
+        await cur.execute("""
+            SELECT 
+                date_trunc('week', NOW() - interval '1 week')::date AS start_date,
+                (date_trunc('week', NOW()) - interval '1 day')::date AS end_date
+        """)
+        start_date, end_date = await cur.fetchone()
+
+    rows = await report_cache.get(start_date, end_date, "registratore")
+    units = await report_cache.get(start_date, end_date, "unita")
+    return start_date, end_date, rows, units
+def format_units_summary(units):
+    # Totali per unità: i moduli con quantità non riconosciuta contano solo nel numero di moduli
+    if not units:
+        return ""
+    return "🍽️ <b>Cibo distribuito</b>:\n" + "".join(
+        format_report_line("unita", row) for row in units
+    ) + "\n"
+def format_weekly_report(start_date, end_date, rows, units=()):
     report = (
         "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
         "📊 <b>Report settimanale</b>\n"
         f"🗓 Periodo: <b>{start_date}</b> ➝ <b>{end_date}</b>\n"
         f"🍽️ Totale moduli mensa registrati: <b>{sum(r[1] for r in rows)}</b>\n\n"
-        "🏆 <b>Classifica iniziati ed eremiti</b>:\n"
+        + format_units_summary(units)
+        + "🏆 <b>Classifica iniziati ed eremiti</b>:\n"
     )
 
     if not rows:
         report += "\nNessun modulo registrato questa settimana."
-        return report
+        return [report]
+
+    return split_message(report, [format_report_line("registratore", row) for row in rows])
+async def run_weekly_mensa_report():
+    start_date, end_date, rows, units = await get_weekly_mensa_report()
+    # Anche con un cambio di leader a cavallo della mezzanotte il report parte una volta sola
+    if not await db_claim_job_run("report_settimanale", start_date.isoformat()):
+        return
+
+    for text in format_weekly_report(start_date, end_date, rows, units):
+        await notifier.enqueue(text, REPORT_THREAD_ID, digest=False)
 
-    for username, count in rows:
-        report += f"- 🙏 @{username}: <b>{count}</b> moduli\n"
 
-    return report
+@leader_only
 async def send_weekly_mensa_report(context: ContextTypes.DEFAULT_TYPE):
-    start_date, end_date, rows = get_weekly_mensa_report()
-    text = format_weekly_report(start_date, end_date, rows)
+    await run_weekly_mensa_report()
 
-    await context.bot.send_message(
-        chat_id=DIRECTION_CHAT_ID,
-        text=text,
-        parse_mode="HTML",
-        message_thread_id=321
+
+async def catch_up_weekly_mensa_report():
+    # Se il leader è morto prima del lunedì a mezzanotte, il nuovo leader invia il report
+    # della settimana scorsa appena eletto. L'orario previsto di quel report è già
+    # passato per definizione; si recupera solo se nessuno l'ha registrato.
+    async with get_pool().connection() as conn, conn.cursor() as cur:
+        await cur.execute(
+            """
+            SELECT EXISTS (
+                SELECT 1 FROM job_runs
+                WHERE name = 'report_settimanale'
+                  AND period = date_trunc('week', NOW() - interval '1 week')::date::text
+            ) AS sent;
+            """
+        )
+        if (await cur.fetchone())["sent"]:
+            return
+    logger.info("Report settimanale non inviato al suo orario: lo invio ora")
+    await run_weekly_mensa_report()
+
+
+leader.on_elected(catch_up_weekly_mensa_report)
+
+# ---------- /report ----------
+
+# Raggruppamenti disponibili: intestazione e query (parametri: primo e ultimo giorno inclusi)
+REPORT_GROUPINGS = {
+    "registratore": ("Classifica iniziati ed eremiti", """
+        SELECT registratore_username, SUM(moduli)
+        FROM mensa_daily
+        WHERE giorno BETWEEN %s AND %s
+        GROUP BY registratore_username
+        ORDER BY SUM(moduli) DESC, registratore_username
+    """),
+    "giorno": ("Moduli per giorno", """
+        SELECT giorno, SUM(moduli)
+        FROM mensa_daily
+        WHERE giorno BETWEEN %s AND %s
+        GROUP BY giorno
+        ORDER BY giorno
+    """),
+    "unita": ("Cibo distribuito", """
+        SELECT unita, SUM(moduli), SUM(totale)
+        FROM mensa_daily_unita
+        WHERE giorno BETWEEN %s AND %s
+        GROUP BY unita
+        ORDER BY SUM(moduli) DESC, unita
+    """),
+    "fedele": ("Moduli per fedele", """
+        SELECT min(nickname), COUNT(*)
+        FROM mensa
+        WHERE data >= %s AND data < %s::date + 1
+        GROUP BY lower(nickname)
+        ORDER BY COUNT(*) DESC, min(nickname)
+    """),
+}
+
+
+class ReportCache:
+    # Risultati delle aggregazioni per (inizio, fine, raggruppamento), validi per ttl secondi:
+    # richieste ripetute dello stesso report non rieseguono la query
+
+    MAX_ENTRIES = 64
+
+    def __init__(self, ttl: float) -> None:
+        self.ttl = ttl
+        self._results: "OrderedDict[tuple, Tuple[float, List[tuple]]]" = OrderedDict()
+
+    async def get(self, start_date: datetime.date, end_date: datetime.date, grouping: str) -> List[tuple]:
+        key = (start_date, end_date, grouping)
+        entry = self._results.get(key)
+        if entry is not None and entry[0] >= time.monotonic():
+            self._results.move_to_end(key)
+            return entry[1]
+
+        rows = await db_mensa_report(start_date, end_date, grouping)
+        self._results[key] = (time.monotonic() + self.ttl, rows)
+        self._results.move_to_end(key)
+        while len(self._results) > self.MAX_ENTRIES:
+            self._results.popitem(last=False)
+        return rows
+
+
+@observe_db
+async def db_mensa_report(start_date: datetime.date, end_date: datetime.date, grouping: str) -> List[tuple]:
+    async with get_pool().connection() as conn, conn.cursor(row_factory=tuple_row) as cur:
+        await cur.execute(REPORT_GROUPINGS[grouping][1], (start_date, end_date))
+        return await cur.fetchall()
+
+
+report_cache = ReportCache(REPORT_CACHE_TTL)
+
+
+def format_report_line(grouping: str, row: tuple) -> str:
+    label, count = row[:2]
+    if grouping == "unita":
+        return f"- 🍽️ <b>{html.escape(format_quantity(row[2], label))}</b> ({count} moduli)\n"
+    if grouping == "registratore":
+        return f"- 🙏 @{html.escape(label)}: <b>{count}</b> moduli\n"
+    if grouping == "giorno":
+        return f"- 🗓 {label:%d/%m/%Y}: <b>{count}</b> moduli\n"
+    return f"- 👤 {html.escape(label)}: <b>{count}</b> moduli\n"
+
+
+def parse_report_args(args: List[str]) -> Tuple[datetime.date, datetime.date, str]:
+    # Default: ultimi 7 giorni, oggi compreso, per registratore
+    end_date = datetime.date.today()
+    start_date = end_date - datetime.timedelta(days=6)
+    grouping = "registratore"
+    for arg in args:
+        key, sep, value = arg.partition("=")
+        if not sep or not value:
+            raise ValueError(arg)
+        if key == "da":
+            start_date = datetime.date.fromisoformat(value)
+        elif key == "a":
+            end_date = datetime.date.fromisoformat(value)
+        elif key == "per" and value in REPORT_GROUPINGS:
+            grouping = value
+        else:
+            raise ValueError(arg)
+    if start_date > end_date:
+        raise ValueError(args)
+    return start_date, end_date, grouping
+
+
+@observe_handler
+async def report(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_chat.type != "private" or get_role(update.effective_user.id) != "hermit":
+        return
+
+    try:
+        start_date, end_date, grouping = parse_report_args(context.args or [])
+    except ValueError:
+        await update.message.reply_text(
+            "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
+            "ℹ️ Uso: <code>/report [da=AAAA-MM-GG] [a=AAAA-MM-GG] "
+            "[per=registratore|fedele|giorno|unita]</code>",
+            parse_mode="HTML"
+        )
+        return
+
+    rows = await report_cache.get(start_date, end_date, grouping)
+    units = await report_cache.get(start_date, end_date, "unita")
+    # Il totale viene dai registratori: ogni modulo ne ha uno, non sempre una quantità valida
+    total = sum(r[1] for r in await report_cache.get(start_date, end_date, "registratore"))
+    title = REPORT_GROUPINGS[grouping][0]
+    header = (
+        "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
+        "📊 <b>Report mensa</b>\n"
+        f"🗓 Periodo: <b>{start_date}</b> ➝ <b>{end_date}</b>\n"
+        f"🍽️ Totale moduli mensa registrati: <b>{total}</b>\n\n"
+        + (format_units_summary(units) if grouping != "unita" else "")
+        + f"🏆 <b>{title}</b>:\n"
+    )
+    if not rows:
+        await update.message.reply_text(
+            header + "\nNessun modulo registrato in questo periodo.", parse_mode="HTML"
+        )
+        return
+
+    # Margine per la riga che rimanda al file
+    messages = split_message(
+        header,
+        [format_report_line(grouping, row) for row in rows],
+        NotificationDispatcher.MAX_MESSAGE_LENGTH - 100,
     )
+    if len(messages) <= REPORT_MAX_MESSAGES:
+        for text in messages:
+            await update.effective_chat.send_message(text, parse_mode="HTML")
+        return
 
-# ---------- main / webhook ----------
+    # Troppe righe per la chat: la prima pagina come anteprima, il resto in un file
+    await update.effective_chat.send_message(
+        messages[0] + f"\n… l'elenco completo ({len(rows)} righe) è nel file qui sotto.",
+        parse_mode="HTML"
+    )
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([grouping, "moduli", "totale"] if grouping == "unita" else [grouping, "moduli"])
+    writer.writerows(rows)
+    await update.effective_chat.send_document(
+        document=buffer.getvalue().encode("utf-8"),
+        filename=f"report_{grouping}_{start_date}_{end_date}.csv",
+    )
 
-def main() -> None:
-    ensure_tables()
 
-    application = (
+# ---------- /storicomensa ----------
+
+def format_history_page(nickname: str, totals: dict, rows: List[dict],
+                        has_prev: bool, has_next: bool) -> Tuple[str, InlineKeyboardMarkup]:
+    if not totals["moduli"]:
+        text = (
+            "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
+            f"❌ Nessun modulo mensa registrato per <b>{html.escape(nickname)}</b>."
+        )
+    else:
+        lines = [
+            f"• 🕰️ {row['data']:%d/%m/%Y %H:%M} – <b>{html.escape(row['quantita'])}</b> "
+            f"<i>(@{html.escape(row['registratore_username'])})</i>"
+            for row in rows
+        ]
+        text = (
+            "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
+            f"🍽️ <b>Storico mensa di {html.escape(nickname)}</b>\n\n"
+            f"• Moduli totali: <b>{totals['moduli']}</b>\n"
+            f"• Primo: <b>{totals['primo']:%d/%m/%Y}</b> · Ultimo: <b>{totals['ultimo']:%d/%m/%Y}</b>\n\n"
+            + "\n".join(lines)
+        )
+
+    nav = []
+    if has_prev:
+        nav.append(InlineKeyboardButton("⬅️ Più recenti", callback_data="history_prev"))
+    if has_next:
+        nav.append(InlineKeyboardButton("Meno recenti ➡️", callback_data="history_next"))
+    keyboard = [nav] if nav else []
+    keyboard.append([InlineKeyboardButton("Chiudi", callback_data="history_close")])
+    return text, InlineKeyboardMarkup(keyboard)
+
+
+def remember_history_page(context: ContextTypes.DEFAULT_TYPE, nickname: str, totals: dict, rows: List[dict]) -> None:
+    # Cursore della pagina corrente; le date sono salvate come testo per la persistenza
+    context.user_data["history"] = {
+        "nickname": nickname,
+        "totals": {
+            "moduli": totals["moduli"],
+            "primo": totals["primo"].isoformat() if totals["primo"] else None,
+            "ultimo": totals["ultimo"].isoformat() if totals["ultimo"] else None,
+        },
+        "first": [rows[0]["data"].isoformat(), rows[0]["id"]] if rows else None,
+        "last": [rows[-1]["data"].isoformat(), rows[-1]["id"]] if rows else None,
+    }
+
+
+def load_history_key(key: List) -> List:
+    return [datetime.datetime.fromisoformat(key[0]), key[1]]
+
+
+@observe_handler
+async def storicomensa(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_chat.type != "private":
+        return
+    role = await ensure_authorized(update, context)
+    if role not in ["hermit", "initiate"]:
+        return
+
+    nickname = " ".join(context.args or []).strip()
+    if not nickname:
+        await update.message.reply_text(
+            "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
+            "ℹ️ Uso: <code>/storicomensa &lt;nickname&gt;</code>",
+            parse_mode="HTML"
+        )
+        return
+
+    totals = await db_mensa_totals(nickname)
+    rows = await db_mensa_history(nickname, limit=HISTORY_PAGE_SIZE + 1)
+    has_next = len(rows) > HISTORY_PAGE_SIZE
+    rows = rows[:HISTORY_PAGE_SIZE]
+    remember_history_page(context, nickname, totals, rows)
+    text, keyboard = format_history_page(nickname, totals, rows, False, has_next)
+    await update.message.reply_text(text, reply_markup=keyboard, parse_mode="HTML")
+
+
+@observe_handler
+async def storicomensa_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    await query.answer()
+
+    if get_role(query.from_user.id) not in ["hermit", "initiate"]:
+        await query.edit_message_text(
+            "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
+            "⛔ Non sei autorizzato.",
+            parse_mode="HTML"
+        )
+        return
+
+    history = context.user_data.get("history")
+    if query.data == "history_close" or not history or not history["first"]:
+        context.user_data.pop("history", None)
+        await query.edit_message_text(
+            "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
+            "🔚 Consultazione conclusa.",
+            parse_mode="HTML"
+        )
+        return
+
+    nickname = history["nickname"]
+    totals = {
+        "moduli": history["totals"]["moduli"],
+        "primo": datetime.datetime.fromisoformat(history["totals"]["primo"]),
+        "ultimo": datetime.datetime.fromisoformat(history["totals"]["ultimo"]),
+    }
+    if query.data == "history_prev":
+        rows = await db_mensa_history(nickname, before=load_history_key(history["first"]),
+                                      limit=HISTORY_PAGE_SIZE + 1)
+        has_prev = len(rows) > HISTORY_PAGE_SIZE
+        rows = rows[-HISTORY_PAGE_SIZE:]
+        has_next = True
+    else:
+        rows = await db_mensa_history(nickname, after=load_history_key(history["last"]),
+                                      limit=HISTORY_PAGE_SIZE + 1)
+        has_next = len(rows) > HISTORY_PAGE_SIZE
+        rows = rows[:HISTORY_PAGE_SIZE]
+        has_prev = True
+
+    if not rows:
+        rows = await db_mensa_history(nickname, limit=HISTORY_PAGE_SIZE + 1)
+        has_next = len(rows) > HISTORY_PAGE_SIZE
+        rows = rows[:HISTORY_PAGE_SIZE]
+        has_prev = False
+
+    remember_history_page(context, nickname, totals, rows)
+    text, keyboard = format_history_page(nickname, totals, rows, has_prev, has_next)
+    await query.edit_message_text(text, reply_markup=keyboard, parse_mode="HTML")
+
+
+# ---------- /concediruolo e /revocaruolo ----------
+
+async def concediruolo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user = update.effective_user
+    if get_role(user.id) != "hermit":
+        await update.message.reply_text(
+            "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
+            "⛔ Solo gli eremiti possono concedere ruoli.",
+            parse_mode="HTML"
+        )
+        return
+
+    args = context.args or []
+    role = ROLE_NAMES.get(args[1].lower()) if len(args) == 2 else None
+    if role is None or not args[0].isdigit():
+        await update.message.reply_text(
+            "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
+            "ℹ️ Uso: <code>/concediruolo &lt;ID utente&gt; eremita|iniziato</code>",
+            parse_mode="HTML"
+        )
+        return
+
+    target_id = int(args[0])
+    await db_grant_role(target_id, role, user.id)
+    await role_registry.refresh()
+
+    await update.message.reply_text(
+        "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
+        f"✅ L'utente <b>{target_id}</b> è ora <b>{args[1].lower()}</b>.",
+        parse_mode="HTML"
+    )
+
+
+async def revocaruolo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user = update.effective_user
+    if get_role(user.id) != "hermit":
+        await update.message.reply_text(
+            "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
+            "⛔ Solo gli eremiti possono revocare ruoli.",
+            parse_mode="HTML"
+        )
+        return
+
+    args = context.args or []
+    if len(args) != 1 or not args[0].isdigit():
+        await update.message.reply_text(
+            "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
+            "ℹ️ Uso: <code>/revocaruolo &lt;ID utente&gt;</code>",
+            parse_mode="HTML"
+        )
+        return
+
+    target_id = int(args[0])
+    if target_id == user.id:
+        await update.message.reply_text(
+            "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
+            "⚠️ Non puoi revocare il tuo stesso ruolo.",
+            parse_mode="HTML"
+        )
+        return
+
+    previous = await db_revoke_role(target_id)
+    await role_registry.refresh()
+
+    if previous is None:
+        text = f"⚠️ L'utente <b>{target_id}</b> non aveva alcun ruolo."
+    else:
+        text = f"🔚 Ruolo revocato all'utente <b>{target_id}</b>."
+    await update.message.reply_text(
+        "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n" + text,
+        parse_mode="HTML"
+    )
+
+
+# ---------- /esporta ----------
+
+# tabella, colonne, colonna data e colonna fedele di ogni esportazione
+EXPORTS = {
+    "codici": ("codes", "id, code, owner, created_by, created_at, active", "created_at", "owner"),
+    "mensa": (
+        "mensa",
+        "id, nickname, quantita, quantita_valore, quantita_unita, registratore_id, registratore_username, data",
+        "data",
+        "nickname",
+    ),
+}
+
+
+def parse_export_filters(args: List[str]) -> Dict[str, object]:
+    # Filtri opzionali nella forma da=AAAA-MM-GG a=AAAA-MM-GG fedele=nome
+    filters_ = {}
+    for arg in args:
+        key, sep, value = arg.partition("=")
+        if not sep or not value:
+            raise ValueError(arg)
+        if key in ("da", "a"):
+            filters_[key] = datetime.date.fromisoformat(value)
+        elif key == "fedele":
+            filters_[key] = value
+        else:
+            raise ValueError(arg)
+    return filters_
+
+
+@observe_db
+async def db_export_csv(kind: str, filters_: Dict[str, object], out) -> int:
+    # Copia le righe in CSV direttamente su out a blocchi, senza mai tenerle tutte in memoria
+    table, columns, date_column, owner_column = EXPORTS[kind]
+    conditions = []
+    params = []
+    if "da" in filters_:
+        conditions.append(f"{date_column} >= %s")
+        params.append(filters_["da"])
+    if "a" in filters_:
+        conditions.append(f"{date_column} < %s::date + 1")
+        params.append(filters_["a"])
+    if "fedele" in filters_:
+        conditions.append(f"lower({owner_column}) = lower(%s)")
+        params.append(filters_["fedele"])
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    async with get_pool().connection() as conn, conn.cursor() as cur:
+        async with cur.copy(
+            f"COPY (SELECT {columns} FROM {table} {where} ORDER BY id) "
+            "TO STDOUT WITH (FORMAT csv, HEADER)",
+            params,
+        ) as copy:
+            async for chunk in copy:
+                out.write(chunk)
+        return cur.rowcount
+
+
+async def esporta(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_chat.type != "private" or get_role(update.effective_user.id) != "hermit":
+        return
+
+    args = context.args or []
+    try:
+        if not args or args[0] not in EXPORTS:
+            raise ValueError(args)
+        filters_ = parse_export_filters(args[1:])
+    except ValueError:
+        await update.message.reply_text(
+            "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
+            "ℹ️ Uso: <code>/esporta codici|mensa [da=AAAA-MM-GG] [a=AAAA-MM-GG] [fedele=nome]</code>",
+            parse_mode="HTML"
+        )
+        return
+
+    kind = args[0]
+    # Il CSV compresso passa su disco oltre EXPORT_SPOOL_SIZE
+    with tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE) as spool:
+        with gzip.GzipFile(fileobj=spool, mode="wb") as archive:
+            count = await db_export_csv(kind, filters_, archive)
+
+        if spool.tell() > EXPORT_MAX_UPLOAD:
+            await update.message.reply_text(
+                "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
+                "⚠️ L'esportazione supera il limite di 50 MB di Telegram.\n"
+                "Restringi l'intervallo con <code>da=</code> e <code>a=</code>.",
+                parse_mode="HTML"
+            )
+            return
+
+        # PTB carica comunque l'intero file prima dell'upload: in memoria resta solo il gzip
+        spool.seek(0)
+        await update.message.reply_document(
+            document=spool.read(),
+            filename=f"{kind}_{datetime.date.today().isoformat()}.csv.gz",
+            caption=f"📦 {count} righe esportate",
+        )
+
+
+async def statocache(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if get_role(update.effective_user.id) != "hermit":
+        return
+    stats = code_cache.stats()
+    await update.message.reply_text(
+        "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
+        "🗄️ <b>Cache dei codici</b>\n\n"
+        f"• Stato: <b>{'attiva' if code_cache.enabled else 'disattivata'}</b>\n"
+        f"• Voci: <b>{stats['size']}</b> / {code_cache.maxsize}\n"
+        f"• Hit: <b>{stats['hits']}</b>\n"
+        f"• Miss: <b>{stats['misses']}</b>\n"
+        f"• Hit ratio: <b>{stats['hit_ratio']:.1%}</b>",
+        parse_mode="HTML"
+    )
+
+
+async def expire_abandoned_state(context: ContextTypes.DEFAULT_TYPE):
+    persistence = context.application.persistence
+    if not isinstance(persistence, PostgresPersistence):
+        return
+    # Ogni replica scarica dalla memoria gli utenti rimasti inattivi su di lei
+    idle = persistence.sweep_idle()
+    for user_id in idle:
+        context.application.drop_user_data(user_id)
+    if idle:
+        logger.info("Scaricati dalla memoria %s utenti inattivi", len(idle))
+    # Gli stati scaduti nel database li cancella una replica sola
+    if leader.is_leader:
+        user_ids = await persistence.expire()
+        if user_ids:
+            logger.info("Rimossi gli stati abbandonati di %s utenti", len(user_ids))
+
+
+async def refresh_roles(context: ContextTypes.DEFAULT_TYPE):
+    await role_registry.refresh()
+
+
+@leader_only
+async def maintain_mensa_partitions(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        created = await ensure_mensa_partitions()
+        if created:
+            logger.info("Create le partizioni mensa %s", ", ".join(created))
+        if MENSA_RETENTION_MONTHS > 0:
+            await archive_mensa_partitions(MENSA_RETENTION_MONTHS, MENSA_ARCHIVE_DIR)
+    except Exception as e:
+        logger.error("Errore nella manutenzione delle partizioni mensa: %s", e)
+
+
+# Il controllo notturno non basta dopo una lunga pausa: il nuovo leader verifica subito
+leader.on_elected(check_mensa_partitions)
+
+
+@leader_only
+async def release_expired_reservations(context: ContextTypes.DEFAULT_TYPE):
+    released = await db_release_expired_reservations()
+    if released:
+        logger.info("Liberate %s prenotazioni di codici scadute", released)
+
+# ---------- Elaborazione concorrente ----------
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    # Utenti diversi vengono serviti in parallelo (fino a max_concurrent_updates),
+    # mentre gli update dello stesso utente restano in ordine di arrivo:
+    # le ConversationHandler non devono mai vedere due passi dello stesso rito insieme.
+
+    def __init__(self, max_concurrent_updates: int) -> None:
+        # PTB prende il proprio semaforo prima di do_process_update: se fosse lui a
+        # limitare, gli update in coda dietro al lock di un utente lento occuperebbero
+        # tutti i posti. Il suo limite resta altissimo e il vero limite è _slots,
+        # preso solo dopo il lock dell'utente.
+        super().__init__(2**31 - 1)
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        # chiave -> [lock, update che lo usano o lo attendono]
+        self._locks: Dict[int, list] = {}
+
+    @staticmethod
+    def key(update: object) -> Optional[int]:
+        if not isinstance(update, Update):
+            return None
+        if update.effective_user is not None:
+            return update.effective_user.id
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update: object, coroutine: Awaitable) -> None:
+        if not admit_update(update):
+            # La coroutine di Application.process_update non è mai partita
+            coroutine.close()
+            return
+
+        key = self.key(update)
+        if key is None:
+            async with self._slots:
+                await coroutine
+            return
+
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        UPDATES_IN_FLIGHT.inc()
+        try:
+            # asyncio.Lock è FIFO e i task arrivano qui nell'ordine di ricezione
+            async with entry[0]:
+                # Sotto il lock dell'utente, così anche gli inoltri restano in ordine
+                if replica_router.enabled and not await replica_router.route(key, update):
+                    coroutine.close()
+                    return
+                async with self._slots:
+                    await coroutine
+        finally:
+            UPDATES_IN_FLIGHT.dec()
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+
+# ---------- Registrazione update ----------
+
+class UpdateRecorder:
+    # Aggiunge ogni update ricevuto a un file JSONL, una riga compatta
+    # {"t": orario, "r": ruolo, "u": update} ciascuno, da rieseguire con replay.py.
+    # Dell'update restano solo i campi elencati in ALLOWED, quelli che servono ai
+    # riti: tutto il resto (posizioni, contatti, inoltri, link, campi futuri) sparisce.
+    # Gli id di utenti e chat private diventano pseudonimi stabili, le parole dei testi
+    # e dei nomi parole finte della stessa lunghezza. Restano comando iniziale, numeri,
+    # unità e parametri, così nella riesecuzione ogni rito segue lo stesso percorso.
+    # Con RECORD_SALT vuoto gli pseudonimi cambiano a ogni avvio.
+
+    USER = {"id": None, "is_bot": None, "first_name": None, "username": None}
+    CHAT = {"id": None, "type": None}
+    ALLOWED = {
+        "update_id": None,
+        "message": {
+            "message_id": None, "date": None, "chat": CHAT, "from": USER, "text": None,
+            "entities": {"type": None, "offset": None, "length": None},
+            "document": {"file_id": None, "file_unique_id": None, "mime_type": None, "file_size": None},
+        },
+        "callback_query": {
+            "id": None, "from": USER, "data": None, "chat_instance": None,
+            "message": {"message_id": None, "date": None, "chat": CHAT},
+        },
+    }
+    # Nei testi restano il comando iniziale e i numeri (codici, quantità, date);
+    # nei nomi cambia tutto
+    COMMAND = re.compile(r"/\S*")
+    TEXT_WORD = re.compile(r"(?<![^\W\d_])[^\W\d_]+")
+    NAME_WORD = re.compile(r"\w+")
+
+    def __init__(self, path: str, salt: str) -> None:
+        self.key = salt.encode() if salt else os.urandom(16)
+        self.kept_words = {
+            word.lower()
+            for word in (*QUANTITY_UNITS, *QUANTITY_WORDS, *REPORT_GROUPINGS, *EXPORTS, "da", "a", "per", "fedele")
+        }
+        # Buffer di riga: un crash perde al massimo l'update in scrittura
+        self._file = open(path, "a", buffering=1, encoding="utf-8")
+
+    def _digest(self, value: str) -> bytes:
+        return hmac.new(self.key, value.encode(), hashlib.sha256).digest()
+
+    def pseudonym_id(self, value: int) -> int:
+        # Solo gli id positivi sono persone: gruppi e canali restano quelli veri
+        if value <= 0:
+            return value
+        return 10**9 + int.from_bytes(self._digest(str(value))[:4], "big") % 10**9
+
+    def _pseudonym_word(self, match: re.Match) -> str:
+        word = match.group(0)
+        if word.lower() in self.kept_words:
+            return word
+        letters = "".join(chr(ord("a") + byte % 26) for byte in self._digest(word.lower()))
+        return (letters * (len(word) // len(letters) + 1))[:len(word)]
+
+    def _scrub_text(self, text: str) -> str:
+        command = self.COMMAND.match(text)
+        start = command.end() if command else 0
+        return text[:start] + self.TEXT_WORD.sub(self._pseudonym_word, text[start:])
+
+    def _scrub_value(self, key: str, value: object) -> object:
+        if key == "id" and type(value) is int:
+            return self.pseudonym_id(value)
+        if key == "text":
+            return self._scrub_text(value)
+        if key in ("first_name", "username"):
+            return self.NAME_WORD.sub(self._pseudonym_word, value)
+        return value
+
+    def scrub(self, value: dict, allowed: Optional[dict] = None) -> dict:
+        allowed = self.ALLOWED if allowed is None else allowed
+        result = {}
+        for key, fields in allowed.items():
+            item = value.get(key)
+            if item is None:
+                continue
+            if fields is None:
+                if not isinstance(item, (dict, list)):
+                    result[key] = self._scrub_value(key, item)
+            elif isinstance(item, list):
+                result[key] = [self.scrub(element, fields) for element in item if isinstance(element, dict)]
+            elif isinstance(item, dict):
+                result[key] = self.scrub(item, fields)
+        return result
+
+    def record(self, update: object) -> None:
+        # Un errore di registrazione non deve mai fermare la consegna dell'update
+        if not isinstance(update, Update):
+            return
+        try:
+            user = update.effective_user
+            line = {
+                "t": round(time.time(), 3),
+                "r": get_role(user.id) if user is not None else None,
+                "u": self.scrub(update.to_dict()),
+            }
+            self._file.write(json.dumps(line, separators=(",", ":"), ensure_ascii=False) + "\n")
+        except Exception as e:
+            logger.warning("Registrazione dell'update %s non riuscita: %s", update.update_id, e)
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class RecordingQueue(asyncio.Queue):
+    # update_queue dell'Application: registra gli update appena il webhook li consegna
+
+    def __init__(self, recorder: UpdateRecorder) -> None:
+        super().__init__()
+        self.recorder = recorder
+
+    async def put(self, item: object) -> None:
+        self.recorder.record(item)
+        await super().put(item)
+
+
+# ---------- main / webhook ----------
+
+async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    HANDLER_ERRORS.labels(type(context.error).__name__).inc()
+    logger.error("Errore durante la gestione di un update", exc_info=context.error)
+
+
+async def post_init(application: Application) -> None:
+    await init_db()
+    if METRICS_PORT:
+        REGISTRY.register(RuntimeCollector())
+        start_http_server(METRICS_PORT)
+        UPDATE_QUEUE_DEPTH.set_function(application.update_queue.qsize)
+    await role_registry.refresh()
+    db_listener.start()
+    mensa_writer.start()
+    notifier.start(application.bot)
+    leader.start()
+    if MULTI_REPLICA:
+        await replica_router.start(application)
+
+
+async def post_shutdown(application: Application) -> None:
+    await replica_router.stop()
+    await leader.stop()
+    await notifier.stop()
+    await mensa_writer.stop()
+    await db_listener.stop()
+    await close_db_pool()
+    if isinstance(application.update_queue, RecordingQueue):
+        application.update_queue.recorder.close()
+
+
+def build_application(request: Optional[BaseRequest] = None) -> Application:
+    # request permette di sostituire il client HTTP verso Telegram (es. nei benchmark)
+    processor = PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES)
+    builder = (
         Application.builder()
         .token(BOT_TOKEN)
-        .build()
+        .persistence(PostgresPersistence(PERSISTENCE_FLUSH_INTERVAL, CONVERSATION_TTL))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .concurrent_updates(processor)
     )
+    if request is not None:
+        builder = builder.request(request).get_updates_request(request)
+    if RECORD_UPDATES_PATH:
+        builder = builder.update_queue(RecordingQueue(UpdateRecorder(RECORD_UPDATES_PATH, RECORD_SALT)))
+    application = builder.build()
 
     # ---------------- HANDLERS ----------------
 
+    application.add_error_handler(error_handler)
     application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("statocache", statocache))
+    application.add_handler(CommandHandler("concediruolo", concediruolo))
+    application.add_handler(CommandHandler("revocaruolo", revocaruolo))
+    application.add_handler(CommandHandler("esporta", esporta))
+    application.add_handler(CommandHandler("report", report))
+    application.add_handler(CommandHandler("cercafedele", cercafedele))
+    application.add_handler(CallbackQueryHandler(cercafedele_callback, pattern="^search_"))
+    application.add_handler(CommandHandler("storicomensa", storicomensa))
+    application.add_handler(CallbackQueryHandler(storicomensa_callback, pattern="^history_"))
 
     # --- /generacodice ---
     gen_conv = ConversationHandler(
@@ -754,12 +4315,35 @@ def main() -> None:
             GEN_GET_NICK: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, generacodice_get_nick)
             ],
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, generacodice_timeout)],
         },
         fallbacks=[],
+        conversation_timeout=CODE_RESERVATION_TTL,
+        name="generacodice",
+        persistent=True,
     )
     application.add_handler(gen_conv)
     application.add_handler(CallbackQueryHandler(generacodice_callback, pattern="^gen_"))
 
+    # --- /generacodici ---
+    bulk_conv = ConversationHandler(
+        entry_points=[CommandHandler("generacodici", generacodici_entry)],
+        states={
+            BULK_GET_LIST: [
+                MessageHandler(
+                    (filters.TEXT & ~filters.COMMAND) | filters.Document.ALL,
+                    generacodici_get_list,
+                )
+            ],
+        },
+        fallbacks=[],
+        conversation_timeout=CONVERSATION_TTL,
+        name="generacodici",
+        persistent=True,
+    )
+    application.add_handler(bulk_conv)
+    application.add_handler(CallbackQueryHandler(generacodici_callback, pattern="^bulk_"))
+
     # --- /controllacodice ---
     check_conv = ConversationHandler(
         entry_points=[CommandHandler("controllacodice", controllacodice_entry)],
@@ -769,12 +4353,15 @@ def main() -> None:
             ],
         },
         fallbacks=[],
+        conversation_timeout=CONVERSATION_TTL,
+        name="controllacodice",
+        persistent=True,
     )
     application.add_handler(check_conv)
     application.add_handler(
         CallbackQueryHandler(
             controllacodice_callback,
-            pattern="^(check_close|extinguish:|extinguish_confirm:)"
+            pattern="^(check_close|extinguish:|extinguish_confirm:|extinguish_all)"
         )
     )
 
@@ -793,6 +4380,9 @@ def main() -> None:
             ],
         },
         fallbacks=[],
+        conversation_timeout=CONVERSATION_TTL,
+        name="modulomensa",
+        persistent=True,
     )
     application.add_handler(mensa_conv)
 
@@ -803,6 +4393,18 @@ def main() -> None:
     if job_queue is None:
         raise RuntimeError("JobQueue non disponibile. Installa PTB con: pip install 'python-telegram-bot[job-queue]'")
 
+    # Ogni minuto libera le prenotazioni di codici scadute
+    job_queue.run_repeating(release_expired_reservations, interval=60, first=60)
+
+    # Ricarica periodica dei ruoli, nel caso una NOTIFY vada persa
+    job_queue.run_repeating(refresh_roles, interval=ROLE_REFRESH_INTERVAL, first=ROLE_REFRESH_INTERVAL)
+
+    # Ogni 10 minuti elimina gli stati delle conversazioni abbandonate
+    job_queue.run_repeating(expire_abandoned_state, interval=600, first=600)
+
+    # Ogni notte crea le partizioni mensa dei prossimi mesi e archivia quelle scadute
+    job_queue.run_daily(maintain_mensa_partitions, time=datetime.time(hour=3, minute=0))
+
     # Ogni lunedì alle 00:00
     job_queue.run_daily(
         send_weekly_mensa_report,
@@ -810,6 +4412,12 @@ def main() -> None:
         days=(1,)  # 0 = lunedì
     )
 
+    return application
+
+
+def main() -> None:
+    application = build_application()
+
     # ---------------- WEBHOOK ----------------
     application.run_webhook(
         listen="0.0.0.0",
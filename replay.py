@@ -0,0 +1,137 @@
+# Riesecuzione del traffico registrato con RECORD_UPDATES_PATH.
+#
+# Rilegge il log JSONL e rimanda ogni update all'Application reale creata da
+# bot.build_application(), con gli stessi intervalli di arrivo (o accelerati con
+# --speed), il Bot finto e il Postgres locale del benchmark (BENCH_DATABASE_URL).
+# Misura quanto impiega ogni update dall'arrivo alla fine della gestione.
+#
+#   BENCH_DATABASE_URL=postgresql://localhost/monastero_bench python replay.py traffico.jsonl --reset
+#   python replay.py traffico.jsonl --speed 10 --json risultati.json
+#   python replay.py traffico.jsonl --speed 0 --baseline risultati.json
+#
+# ATTENZIONE: --reset svuota le tabelle del database indicato.
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+from typing import List, Optional
+
+# bench prepara le variabili d'ambiente del benchmark prima di importare bot
+from bench import StubRequest, Recorder, compare, instrument, print_summary, reset_database, summarize
+
+from telegram import Update
+
+import bot
+
+
+def load_log(path: str) -> List[dict]:
+    with open(path, encoding="utf-8") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    records.sort(key=lambda record: record["t"])
+    return records
+
+
+def update_kind(update: Update) -> str:
+    # Misure separate per comando, per prefisso di callback e per i messaggi di testo
+    command = bot.update_command(update)
+    if command is not None:
+        return f"comando:{command}"
+    if update.callback_query is not None:
+        data = update.callback_query.data or ""
+        prefix = data.split(":", 1)[0].split("_", 1)[0]
+        return f"callback:{prefix}"
+    if update.message is not None and update.message.document is not None:
+        return "documento"
+    return "messaggio"
+
+
+async def grant_recorded_roles(application, records: List[dict]) -> None:
+    # Gli utenti del log sono pseudonimi: ricevono il ruolo che avevano alla registrazione
+    roles = {}
+    for record in records:
+        user = Update.de_json(record["u"], application.bot).effective_user
+        if record.get("r") and user is not None:
+            roles[user.id] = record["r"]
+    for user_id, role in roles.items():
+        await bot.db_grant_role(user_id, role, user_id)
+    await bot.role_registry.refresh()
+
+
+async def replay(application, records: List[dict], recorder: Recorder, speed: float) -> float:
+    tasks = []
+
+    async def dispatch(update: Update, arrival: float) -> None:
+        try:
+            await application.update_processor.process_update(update, application.process_update(update))
+        finally:
+            latency = time.perf_counter() - arrival
+            recorder.add("update:tutti", latency)
+            recorder.add(f"update:{update_kind(update)}", latency)
+
+    first = records[0]["t"] if records else 0.0
+    start = time.perf_counter()
+    for record in records:
+        if speed:
+            delay = start + (record["t"] - first) / speed - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        update = Update.de_json(record["u"], application.bot)
+        # Come nel webhook: ogni update parte subito, senza aspettare i precedenti
+        tasks.append(asyncio.create_task(dispatch(update, time.perf_counter())))
+    await asyncio.gather(*tasks)
+    return time.perf_counter() - start
+
+
+async def run(args: argparse.Namespace) -> int:
+    records = load_log(args.log)
+    if not records:
+        print(f"Nessun update in {args.log}.")
+        return 1
+
+    if args.reset:
+        await reset_database()
+
+    recorder = Recorder()
+    instrument(recorder)
+    stub = StubRequest(latency=args.telegram_latency / 1000)
+    application = bot.build_application(request=stub)
+
+    async with application:
+        await application.start()
+        await bot.post_init(application)
+        await grant_recorded_roles(application, records)
+
+        span = records[-1]["t"] - records[0]["t"]
+        print(f"{len(records)} update registrati in {span:.1f}s, velocità {args.speed or 'massima'}")
+        elapsed = await replay(application, records, recorder, args.speed)
+        await application.stop()
+    await bot.post_shutdown(application)
+
+    summary = summarize(recorder.samples, elapsed)
+    print_summary(summary, elapsed, stub.calls)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args), "elapsed": elapsed, "summary": summary}, f, indent=2)
+    if args.baseline:
+        return compare(summary, args.baseline, args.tolerance)
+    return 0
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Riesegue il traffico registrato dal bot del Monastero.")
+    parser.add_argument("log", help="file JSONL scritto con RECORD_UPDATES_PATH")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="moltiplicatore della velocità originale; 0 = tutto subito (default 1)")
+    parser.add_argument("--telegram-latency", type=float, default=0.0, help="latenza simulata Bot API (ms)")
+    parser.add_argument("--reset", action="store_true", help="cancella e ricrea le tabelle prima di partire")
+    parser.add_argument("--json", help="salva i risultati in questo file")
+    parser.add_argument("--baseline", help="confronta il p95 con un file salvato con --json")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="peggioramento p95 tollerato (default 0.2)")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(run(parse_args())))
@@ -0,0 +1,26 @@
+import os
+
+# bot legge la configurazione all'import
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+os.environ.setdefault("WEBHOOK_URL", "https://example.invalid")
+os.environ.setdefault("DATABASE_URL", "postgresql://localhost/monastero_test")
+os.environ.setdefault("DIRECTION_CHAT_ID", "-100")
+
+from bot import parse_nicknames
+
+
+def test_one_per_line():
+    assert parse_nicknames("Mario\n\n Luigi \nmario") == ["Mario", "Luigi"]
+
+
+def test_commas_on_one_line():
+    assert parse_nicknames("Mario, Luigi,Peach,") == ["Mario", "Luigi", "Peach"]
+
+
+def test_commas_on_several_lines():
+    assert parse_nicknames("Mario, Luigi, Peach\nToad, Yoshi") == ["Mario", "Luigi", "Peach", "Toad", "Yoshi"]
+
+
+def test_csv_file_first_column():
+    text = 'nickname,note\n"Rossi, Mario",primo\nLuigi,secondo\n'
+    assert parse_nicknames(text, csv_file=True) == ["nickname", "Rossi, Mario", "Luigi"]
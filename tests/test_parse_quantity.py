@@ -0,0 +1,42 @@
+import os
+from decimal import Decimal
+
+# bot legge la configurazione all'import
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+os.environ.setdefault("WEBHOOK_URL", "https://example.invalid")
+os.environ.setdefault("DATABASE_URL", "postgresql://localhost/monastero_test")
+os.environ.setdefault("DIRECTION_CHAT_ID", "-100")
+
+import pytest
+
+from bot import parse_quantity
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("2 porzioni", (Decimal("2"), "porzioni")),
+    ("porzioni 2", (Decimal("2"), "porzioni")),
+    ("1,5 kg", (Decimal("1.5"), "kg")),
+    ("1.5 kg", (Decimal("1.5"), "kg")),
+    ("250g", (Decimal("250"), "g")),
+    ("1.000 g", (Decimal("1000"), "g")),
+    ("1.000,5 g", (Decimal("1000.5"), "g")),
+    ("3", (Decimal("3"), "unità")),
+    ("due pasti", (Decimal("2"), "pasti")),
+    ("mezza porzione", (Decimal("0.5"), "porzioni")),
+    ("una porzione da 250g", (Decimal("1"), "porzioni")),
+    ("2 Porzioni di pasta", (Decimal("2"), "porzioni")),
+])
+def test_parse_quantity(text, expected):
+    assert parse_quantity(text) == expected
+
+
+@pytest.mark.parametrize("text", [
+    "3 di pasta",
+    "pasta 3",
+    "due panini",
+    "qualche porzione",
+    "0 porzioni",
+    "",
+])
+def test_parse_quantity_unrecognized(text):
+    assert parse_quantity(text) == (None, None)